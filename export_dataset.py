@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Export of triplets joined with titles and abstracts into one dataset folder:
+
+    ids.npy           bytes   (n_papers,)          arxiv ids of the papers used by triplets
+    texts.bin         utf-8                        title and abstract of every paper, one after another
+    text_offsets.npy  int64   (2 * n_papers + 1,)  title of paper i is texts[offsets[2i]:offsets[2i + 1]],
+                                                   abstract is texts[offsets[2i + 1]:offsets[2i + 2]]
+    triplets.npy      int32   (n_triplets, 3)      (target, context, negative) indexes of papers
+    distances.npy     float32 (n_triplets, 2)      dist_to_context, dist_to_negative
+
+Every paper is stored once, however many triplets refer to it.
+"""
+import os
+import sys
+import json
+import mmap
+import logging
+import argparse
+import multiprocessing as mp
+from array import array
+import numpy as np
+from tqdm.auto import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser'))
+from utils import atomic_open
+from metastore import open_meta_store
+
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logging(logger):
+    logger.setLevel(logging.INFO)
+
+    log_formatter = logging.Formatter(
+        fmt='[%(asctime)s] %(levelname)s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+    logger.addHandler(console_handler)
+
+
+def read_triplets(triplets_paths):
+    """
+    Returns ids of papers in the order of first use, triplets as indexes of them and distances.
+    """
+    papers = {}
+    triplets = array('i')
+    distances = array('f')
+    for path in triplets_paths:
+        with open(path) as f:
+            for line in tqdm(f, desc=os.path.basename(path)):
+                triplet = json.loads(line)
+                for key in ('target', 'context', 'negative'):
+                    triplets.append(papers.setdefault(triplet[key], len(papers)))
+                distances.append(triplet['dist_to_context'])
+                distances.append(triplet['dist_to_negative'])
+    return (list(papers),
+            np.frombuffer(triplets, dtype=np.int32).reshape(-1, 3),
+            np.frombuffer(distances, dtype=np.float32).reshape(-1, 2))
+
+
+meta_store = None
+
+
+def init_worker(store):
+    global meta_store
+    meta_store = store
+
+
+def get_texts(paper):
+    meta = meta_store.get_meta(paper)
+    if meta is None:
+        return None
+    return meta['title'] or '', meta['abstract'] or ''
+
+
+def export(triplets_paths, store, out_dir, workers):
+    ids, triplets, distances = read_triplets(triplets_paths)
+    logger.info('Triplets: {}, papers: {}.'.format(len(triplets), len(ids)))
+
+    offsets = array('q', [0])
+    missing = 0
+    with atomic_open(os.path.join(out_dir, 'texts.bin'), 'wb') as f, \
+            mp.Pool(workers, initializer=init_worker, initargs=(store,)) as pool:
+        for texts in tqdm(pool.imap(get_texts, ids, chunksize=256), total=len(ids), desc='Texts'):
+            if texts is None:
+                missing += 1
+                texts = ('', '')
+            for text in texts:
+                offsets.append(offsets[-1] + f.write(text.encode('utf-8')))
+
+    arrays = {'ids': np.array(ids, dtype='S'),
+              'text_offsets': np.frombuffer(offsets, dtype=np.int64),
+              'triplets': triplets,
+              'distances': distances}
+    for name, values in arrays.items():
+        with atomic_open(os.path.join(out_dir, name + '.npy'), 'wb') as f:
+            np.save(f, values)
+    if missing:
+        logger.warning('Meta is not found for {} papers, their texts are empty.'.format(missing))
+
+
+class TripletDataset:
+    """
+    Reader of an exported dataset. Arrays and texts are memory-mapped, so random access reads only
+    the requested items and worker processes share the pages of one file. Files are opened on first
+    access in every process, so the dataset can be passed to DataLoader workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.arrays = None
+        self.texts = None
+
+    def open(self):
+        self.arrays = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+                       for name in ('ids', 'text_offsets', 'triplets', 'distances')}
+        with open(os.path.join(self.path, 'texts.bin'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.texts = b''
+
+    def __getstate__(self):
+        return {'path': self.path, 'arrays': None, 'texts': None}
+
+    def __len__(self):
+        if self.arrays is None:
+            self.open()
+        return len(self.arrays['triplets'])
+
+    def text(self, k):
+        start, end = self.arrays['text_offsets'][k:k + 2]
+        return self.texts[start:end].decode('utf-8')
+
+    def paper(self, i):
+        """
+        Returns {'id', 'title', 'abstract'} of paper i.
+        """
+        if self.arrays is None:
+            self.open()
+        return {'id': self.arrays['ids'][i].decode(), 'title': self.text(2 * i), 'abstract': self.text(2 * i + 1)}
+
+    def __getitem__(self, i):
+        """
+        Returns triplet i as a dict like in the triplets file, with papers instead of ids.
+        """
+        if self.arrays is None:
+            self.open()
+        target, context, negative = self.arrays['triplets'][i].tolist()
+        dist_to_context, dist_to_negative = self.arrays['distances'][i].tolist()
+        return {'target': self.paper(target), 'context': self.paper(context), 'negative': self.paper(negative),
+                'dist_to_context': dist_to_context, 'dist_to_negative': dist_to_negative}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--triplets', nargs='+', required=True,
+                        help='Triplets files (.jsonl) to export.')
+    parser.add_argument('--arxiv-dir', default='arxiv',
+                        help='Folder name where stored papers(meta, txt, pdf).')
+    parser.add_argument('--meta-store', default='files', choices=['files', 'packed'],
+                        help='files - json file per paper, packed - per-shard segments in arxiv dir/meta.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of hash folders in arxiv dir.')
+    parser.add_argument('--out-dir', default='dataset',
+                        help='Folder name where the dataset is stored.')
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int,
+                        help='Count of processes reading meta.')
+    args = parser.parse_args()
+
+    setup_logging(logger)
+
+    if not os.path.exists(args.out_dir):
+        os.mkdir(args.out_dir)
+
+    export(args.triplets, open_meta_store(args.meta_store, args.arxiv_dir, args.seed, args.shards),
+           args.out_dir, args.workers)
+    logger.info('Dataset is ready! ({})'.format(args.out_dir))
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 import os
-import mmh3
+import sys
 import argparse
 import shutil
 from tqdm.auto import tqdm
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser'))
+from storage import ShardedStorage
+
 
 logger = logging.getLogger(__name__)
 
@@ -23,26 +26,22 @@ def setup_logging(logger):
     logger.addHandler(console_handler)
 
 
-def start_move(task_fold, folder_list, done_fold, seed):
+def start_move(task_fold, folder_list, storage):
     logger.info('Folders in progress...')
     for folder in tqdm(folder_list):
-        dir_path = os.path.join(done_fold, str(mmh3.hash(folder, seed) % 500), folder)
+        dir_path = storage.paper_dir(folder)
         if not os.path.exists(dir_path):
             shutil.move(os.path.join(task_fold, folder),
                         os.path.join(dir_path))
     logger.info('All folders copied!')
 
 
-def make_dirs(fold_path):
-    for i in range(500):
-        if not os.path.exists(os.path.join(fold_path, str(i))):
-            os.mkdir(os.path.join(fold_path, str(i)))
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seed', default=42,
+    parser.add_argument('--seed', default=42, type=int,
                         help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of hash folders.')
     parser.add_argument('--tasks-dir', default='arxiv_tmp',
                         help='Folder where older folders are stored.')
     parser.add_argument('--done-dir', default='arxiv',
@@ -51,6 +50,7 @@ if __name__ == '__main__':
 
     setup_logging(logger)
 
-    make_dirs(args.done_dir)
+    storage = ShardedStorage(args.done_dir, args.seed, args.shards)
+    storage.make_shards()
 
-    start_move(args.tasks_dir, os.listdir(args.tasks_dir), args.done_dir, args.seed)
+    start_move(args.tasks_dir, os.listdir(args.tasks_dir), storage)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import multiprocessing as mp
+from tqdm.auto import tqdm
+from utils import setup_logging
+from utils import paper_id
+from utils import sqlite_journal_mode
+from metastore import PackedMetaStore
+
+
+logger = logging.getLogger(__name__)
+
+# Bits of `papers.state`.
+META = 1
+PDF = 2
+LAYOUT = 4
+COMPLETE = META | PDF | LAYOUT
+
+layout_exts = ('.json', '.jsonl', '.npz', '.txt')
+
+
+class Catalog:
+    """
+    SQLite catalog of papers and the state of their artifacts. Papers are keyed by arxiv id without
+    version, so meta (stored by id) and pdf/layout (stored by versioned file name) meet in one row.
+    Every process opens its own Catalog, WAL mode lets readers work while a writer commits. WAL is
+    unsafe on network filesystems, where the catalog falls back to the rollback journal.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=%s' % sqlite_journal_mode(path))
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS papers ('
+                        'arxiv_id TEXT PRIMARY KEY, state INTEGER NOT NULL DEFAULT 0, '
+                        'date TEXT, categories TEXT, meta_size INTEGER, meta_updated REAL, '
+                        'pdf_name TEXT, pdf_size INTEGER, pdf_md5 TEXT, pdf_updated REAL, '
+                        'layout_name TEXT, layout_size INTEGER, layout_updated REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS papers_state ON papers(state)')
+        self.db.commit()
+
+    def transaction(self):
+        """
+        Groups updates into one commit: `with catalog.transaction(): ...`.
+        """
+        return self.db
+
+    def update_meta(self, arxiv_id, date, categories, size=None):
+        self.db.execute('INSERT INTO papers (arxiv_id, state, date, categories, meta_size, meta_updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(arxiv_id) DO UPDATE SET '
+                        'state = state | excluded.state, date = excluded.date, categories = excluded.categories, '
+                        'meta_size = excluded.meta_size, meta_updated = excluded.meta_updated',
+                        (arxiv_id, META, date, categories, size, time.time()))
+
+    def update_pdf(self, arxiv_id, name, size, md5=None):
+        self.db.execute('INSERT INTO papers (arxiv_id, state, pdf_name, pdf_size, pdf_md5, pdf_updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(arxiv_id) DO UPDATE SET '
+                        'state = state | excluded.state, pdf_name = excluded.pdf_name, '
+                        'pdf_size = excluded.pdf_size, pdf_md5 = COALESCE(excluded.pdf_md5, pdf_md5), '
+                        'pdf_updated = excluded.pdf_updated',
+                        (arxiv_id, PDF, name, size, md5, time.time()))
+
+    def update_layout(self, arxiv_id, name, size):
+        self.db.execute('INSERT INTO papers (arxiv_id, state, layout_name, layout_size, layout_updated) '
+                        'VALUES (?, ?, ?, ?, ?) ON CONFLICT(arxiv_id) DO UPDATE SET '
+                        'state = state | excluded.state, layout_name = excluded.layout_name, '
+                        'layout_size = excluded.layout_size, layout_updated = excluded.layout_updated',
+                        (arxiv_id, LAYOUT, name, size, time.time()))
+
+    def complete_papers(self, with_date=False):
+        """
+        Yields (arxiv_id, categories) or, `with_date`, (arxiv_id, categories, date) of papers that have
+        meta, pdf and layout.
+        """
+        columns = 'arxiv_id, categories, date' if with_date else 'arxiv_id, categories'
+        return self.db.execute('SELECT %s FROM papers WHERE state = ?' % columns, (COMPLETE,))
+
+    def layout_name(self, arxiv_id):
+        row = self.db.execute('SELECT layout_name FROM papers WHERE arxiv_id = ?', (arxiv_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def close(self):
+        self.db.close()
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def scan_shard(args):
+    """
+    Returns artifacts found in one shard folder as (kind, arxiv_id, values) tuples.
+    """
+    shard_path, with_md5 = args
+    found = []
+    for paper in os.listdir(shard_path):
+        paper_path = os.path.join(shard_path, paper)
+        if not os.path.isdir(paper_path):
+            continue
+        arxiv_id = paper_id(paper)
+        # Plain text goes first, so a layout converted next to it (mode 'both') is the recorded one.
+        for name in sorted(os.listdir(paper_path), key=lambda name: not name.endswith('.txt')):
+            path = os.path.join(paper_path, name)
+            try:
+                if name == paper:
+                    with open(path) as f:
+                        meta = json.load(f)
+                    found.append(('meta', meta['id'], (meta['date'], meta['categories'], os.path.getsize(path))))
+                elif name.endswith('.pdf'):
+                    found.append(('pdf', arxiv_id, (name, os.path.getsize(path),
+                                                    file_md5(path) if with_md5 else None)))
+                elif name.endswith(layout_exts):
+                    found.append(('layout', arxiv_id, (name, os.path.getsize(path))))
+            except Exception as e:
+                logger.error('%s: %s' % (path, e))
+    return found
+
+
+def rebuild(catalog, arx_path, workers, with_md5=False, meta_store=None):
+    shards = [(os.path.join(arx_path, shard), with_md5) for shard in os.listdir(arx_path)
+              if os.path.isdir(os.path.join(arx_path, shard))]
+    updates = {'meta': catalog.update_meta, 'pdf': catalog.update_pdf, 'layout': catalog.update_layout}
+    count = 0
+    with mp.Pool(workers) as pool:
+        for found in tqdm(pool.imap_unordered(scan_shard, shards), total=len(shards), desc='Scanning shards'):
+            with catalog.transaction():
+                for kind, arxiv_id, values in found:
+                    updates[kind](arxiv_id, *values)
+            count += len(found)
+    if meta_store is not None:
+        for shard in tqdm(meta_store.segments(), desc='Scanning meta segments'):
+            with catalog.transaction():
+                for arxiv_id, meta, size in meta_store.iter_records(shard):
+                    catalog.update_meta(meta['id'], meta['date'], meta['categories'], size)
+                    count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild-catalog'],
+                        help='rebuild-catalog - backfill the catalog from an existing arxiv dir.')
+    parser.add_argument('--log',
+                        help='Log filename.')
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='Set logger mode to debug.')
+    parser.add_argument('--arxiv-dir', default='arxiv',
+                        help='Folder name where papers(meta, txt, pdf) are stored.')
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog filename (default: catalog.sqlite in arxiv dir), keep it on local disk '
+                             'if arxiv dir is on NFS.')
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int,
+                        help='Count of processes scanning shards.')
+    parser.add_argument('--md5', default=False, action='store_true',
+                        help='Compute md5 of every pdf.')
+    parser.add_argument('--meta-store', default='files', choices=['files', 'packed'],
+                        help='files - json file per paper, packed - per-shard segments in arxiv dir/meta.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of meta segments.')
+    args = parser.parse_args()
+
+    setup_logging(logger, args)
+
+    catalog = Catalog(args.catalog or os.path.join(args.arxiv_dir, 'catalog.sqlite'))
+    logger.info('Rebuilding catalog...')
+    meta_store = None
+    if args.meta_store == 'packed':
+        meta_store = PackedMetaStore(os.path.join(args.arxiv_dir, 'meta'), args.seed, args.shards)
+    count = rebuild(catalog, args.arxiv_dir, args.workers, args.md5, meta_store)
+    logger.info('Catalog is ready! %d artifacts recorded.' % count)
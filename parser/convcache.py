@@ -0,0 +1,89 @@
+import os
+import time
+import shutil
+import hashlib
+import sqlite3
+from utils import sqlite_journal_mode
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ConversionCache:
+    """
+    Index of converted outputs by content hash of the source pdf, converter version and output kind.
+    A hit links (or copies, if linking is impossible) the output that was already produced for an
+    identical pdf instead of converting it again.
+    """
+    def __init__(self, path, version):
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=%s' % sqlite_journal_mode(path))
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'key TEXT PRIMARY KEY, path TEXT, size INTEGER, version TEXT, created REAL)')
+        self.db.commit()
+
+    def key(self, digest, kind):
+        return '%s:%s:%s' % (digest, self.version, kind)
+
+    def lookup(self, key):
+        """
+        Returns path of the cached output, entries whose file is gone are removed.
+        """
+        row = self.db.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.exists(row[0]):
+            with self.db:
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            return None
+        return row[0]
+
+    def fetch(self, key, dst_path):
+        return self.fetch_all([(key, dst_path)])
+
+    def fetch_all(self, entries):
+        """
+        Links the outputs of (key, dst_path) entries only if all of them are cached, so a document
+        counts as one hit or one miss.
+        """
+        src_paths = [self.lookup(key) for key, dst_path in entries]
+        if None in src_paths:
+            self.misses += 1
+            return False
+        self.hits += 1
+        for src_path, (key, dst_path) in zip(src_paths, entries):
+            if os.path.abspath(src_path) == os.path.abspath(dst_path):
+                continue
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copy2(src_path, dst_path)
+        return True
+
+    def store(self, key, path):
+        if not os.path.exists(path):
+            return
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                            (key, os.path.abspath(path), os.path.getsize(path), self.version, time.time()))
+
+    def evict(self):
+        """
+        Removes entries of other converter versions. Returns count of removed entries.
+        """
+        with self.db:
+            return self.db.execute('DELETE FROM entries WHERE version != ?', (self.version,)).rowcount
+
+    def stats(self):
+        count, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return count, size
@@ -0,0 +1,130 @@
+"""
+Compact in-memory corpus for triplet generation.
+
+Papers are stored as columns instead of a list of `[id, [categories]]`:
+
+    ids          bytes   (n_papers,)       arxiv ids, fixed width ('S')
+    cat_offsets  int64   (n_papers + 1,)   categories of paper i are cat_ids[cat_offsets[i]:cat_offsets[i + 1]]
+    cat_ids      int16   (n_cat_refs,)     indexes into `categories`, in the order of the meta
+    dates        datetime64[D] (n_papers,) NaT if the date is unknown
+    categories   str     (n_categories,)   interned category names
+
+A snapshot of these arrays (`.npz`) is reused while the catalog it was built from is unchanged.
+"""
+import os
+import logging
+from array import array
+import numpy as np
+from utils import atomic_open
+
+
+logger = logging.getLogger(__name__)
+
+
+class Corpus:
+    def __init__(self, ids, cat_offsets, cat_ids, categories, dates=None):
+        self.ids = ids
+        self.cat_offsets = cat_offsets
+        self.cat_ids = cat_ids
+        self.categories = categories
+        self.dates = dates if dates is not None else np.full(len(ids), 'NaT', dtype='datetime64[D]')
+        self.category_names = categories.tolist()
+
+    @classmethod
+    def from_papers(cls, papers):
+        """
+        Builds a corpus from (arxiv_id, categories, date) tuples, where categories is a space
+        separated string like in the meta.
+        """
+        ids = []
+        dates = []
+        cat_offsets = array('q', [0])
+        cat_ids = array('h')
+        index = {}
+        for arxiv_id, categories, date in papers:
+            ids.append(arxiv_id)
+            dates.append(date or 'NaT')
+            for cat in categories.split():
+                cat_id = index.get(cat)
+                if cat_id is None:
+                    cat_id = index[cat] = len(index)
+                cat_ids.append(cat_id)
+            cat_offsets.append(len(cat_ids))
+        return cls(np.array(ids, dtype='S'),
+                   np.frombuffer(cat_offsets, dtype=np.int64),
+                   np.frombuffer(cat_ids, dtype=np.int16),
+                   np.array(sorted(index, key=index.get), dtype=str),
+                   np.array(dates, dtype='datetime64[D]'))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['ids'], arrays['cat_offsets'], arrays['cat_ids'], arrays['categories'],
+                       arrays['dates'])
+
+    def save(self, f, **extra):
+        np.savez(f, ids=self.ids, cat_offsets=self.cat_offsets, cat_ids=self.cat_ids,
+                 categories=self.categories, dates=self.dates, **extra)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def paper_cats(self, i):
+        return self.cat_ids[self.cat_offsets[i]:self.cat_offsets[i + 1]]
+
+    def __getitem__(self, i):
+        """
+        Returns a paper as `[arxiv_id, [categories]]`, the format used by triplets_maker.
+        """
+        return [self.ids[i].decode(), [self.category_names[c] for c in self.paper_cats(i)]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def gather_cats(self, indexes):
+        """
+        Returns (cat_offsets, cat_ids) of the papers at `indexes` in the CSR layout of the corpus.
+        """
+        starts = self.cat_offsets[indexes]
+        counts = self.cat_offsets[indexes + 1] - starts
+        cat_offsets = np.zeros(len(indexes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=cat_offsets[1:])
+        cat_ids = self.cat_ids[np.repeat(starts - cat_offsets[:-1], counts) + np.arange(cat_offsets[-1])]
+        return cat_offsets, cat_ids
+
+    def take(self, indexes):
+        """
+        Returns a corpus of the papers at `indexes`, in that order.
+        """
+        cat_offsets, cat_ids = self.gather_cats(indexes)
+        return Corpus(self.ids[indexes], cat_offsets, cat_ids, self.categories, self.dates[indexes])
+
+    def shuffle(self, rng=np.random):
+        return self.take(rng.permutation(len(self)))
+
+
+def source_mtime(paths):
+    return max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0.0)
+
+
+def load_corpus(snapshot_path, source_paths, read_papers):
+    """
+    Loads the corpus snapshot if it was built from the current state of `source_paths`, otherwise
+    builds the corpus from `read_papers()` and saves a new snapshot.
+    """
+    mtime = source_mtime(source_paths)
+    if os.path.exists(snapshot_path):
+        try:
+            with np.load(snapshot_path) as arrays:
+                fresh = float(arrays['source_mtime']) == mtime
+            if fresh:
+                logger.info('Corpus is loading from snapshot...')
+                return Corpus.load(snapshot_path)
+        except Exception as e:
+            logger.warning('%s: %s' % (snapshot_path, e))
+
+    corpus = Corpus.from_papers(read_papers())
+    with atomic_open(snapshot_path, 'wb') as f:
+        corpus.save(f, source_mtime=np.float64(mtime))
+    return corpus
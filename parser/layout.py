@@ -0,0 +1,312 @@
+"""
+Compact layout format for converted pdfs.
+
+A `.npz` layout file holds the same data as the json output of pdf2txt, in flat arrays:
+
+    text          uint8   (n_bytes,)       utf-8 text of all lines, one after another
+    line_offsets  int64   (n_lines + 1,)   line i is text[line_offsets[i]:line_offsets[i + 1]]
+    line_bbox     float32 (n_lines, 4)
+    block_bbox    float32 (n_blocks, 4)
+    block_lines   int32   (n_blocks + 1,)  lines of block i are block_lines[i]:block_lines[i + 1]
+    flow_blocks   int32   (n_flows + 1,)   blocks of flow i
+    page_flows    int32   (n_pages + 1,)   flows of page i
+
+Bboxes are stored as float32, so they are rounded compared to the json output.
+
+A `.jsonl` layout file holds one page of the json output per line.
+
+Json, jsonl and txt outputs have a page index next to them (`<output>.idx`, npy int64 (n_pages, 2)):
+page i is bytes [start, end) of the output. The npz layout is indexed by its own offset arrays;
+pdf2txt writes it uncompressed, so `open_npz` maps the arrays and a page reads only its slices.
+"""
+import os
+import mmap
+import struct
+import zipfile
+from array import array
+import numpy as np
+import ujson
+
+
+class LayoutBuilder:
+    """
+    Collects a document line by line without building a dict per line.
+    """
+    def __init__(self):
+        self.text = bytearray()
+        self.line_offsets = array('q', [0])
+        self.line_bbox = array('f')
+        self.block_bbox = array('f')
+        self.block_lines = array('i', [0])
+        self.flow_blocks = array('i', [0])
+        self.page_flows = array('i', [0])
+
+    def add_line(self, text, bbox):
+        self.text += text.encode('utf-8')
+        self.line_offsets.append(len(self.text))
+        self.line_bbox.extend(bbox)
+
+    def end_block(self, bbox):
+        self.block_bbox.extend(bbox)
+        self.block_lines.append(len(self.line_offsets) - 1)
+
+    def end_flow(self):
+        self.flow_blocks.append(len(self.block_lines) - 1)
+
+    def end_page(self):
+        self.page_flows.append(len(self.flow_blocks) - 1)
+
+    def arrays(self):
+        return {
+            'text': np.frombuffer(bytes(self.text), dtype=np.uint8),
+            'line_offsets': np.frombuffer(self.line_offsets, dtype=np.int64),
+            'line_bbox': np.frombuffer(self.line_bbox, dtype=np.float32).reshape(-1, 4),
+            'block_bbox': np.frombuffer(self.block_bbox, dtype=np.float32).reshape(-1, 4),
+            'block_lines': np.frombuffer(self.block_lines, dtype=np.int32),
+            'flow_blocks': np.frombuffer(self.flow_blocks, dtype=np.int32),
+            'page_flows': np.frombuffer(self.page_flows, dtype=np.int32),
+        }
+
+    def save(self, f):
+        np.savez(f, **self.arrays())
+
+
+class PageWriter:
+    """
+    Writes pages to a binary file and records the byte range of every page for the page index.
+    """
+    head = b''
+    separator = b''
+    tail = b''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.offset = self.f.write(self.head)
+        self.pages = array('q')
+
+    def dumps(self, page):
+        return page
+
+    def write_page(self, page):
+        if self.count:
+            self.offset += self.f.write(self.separator)
+        data = self.dumps(page).encode('utf-8')
+        self.pages.append(self.offset)
+        self.offset += self.f.write(data)
+        self.pages.append(self.offset)
+        self.count += 1
+
+    def close(self):
+        self.f.write(self.tail)
+
+    def save_index(self, f):
+        np.save(f, np.frombuffer(self.pages, dtype=np.int64).reshape(-1, 2))
+
+
+class JsonWriter(PageWriter):
+    """
+    Writes the json list of pages page by page.
+    """
+    head = b'['
+    separator = b','
+    tail = b']'
+
+    def dumps(self, page):
+        return ujson.dumps(page, indent=4, ensure_ascii=False)
+
+
+class JsonlWriter(PageWriter):
+    def dumps(self, page):
+        return ujson.dumps(page, ensure_ascii=False) + '\n'
+
+
+class TextWriter(PageWriter):
+    """
+    Plain text, pages are separated by form feed ('\\f').
+    """
+    separator = b'\f'
+
+
+def npz_page(arrays, p):
+    """
+    Rebuilds page `p` of a `.npz` layout, reading only the lines of that page.
+    """
+    page_flows = arrays['page_flows']
+    flow_blocks = arrays['flow_blocks']
+    block_lines = arrays['block_lines']
+    line_offsets = arrays['line_offsets']
+    f1, f2 = page_flows[p:p + 2].tolist()
+    b1, b2 = flow_blocks[f1], flow_blocks[f2]
+    l1, l2 = block_lines[b1], block_lines[b2]
+    text = arrays['text'][line_offsets[l1]:line_offsets[l2]].tobytes()
+    lines = (line_offsets[l1:l2 + 1] - line_offsets[l1]).tolist()
+    line_bbox = arrays['line_bbox'][l1:l2].tolist()
+    block_bbox = arrays['block_bbox'][b1:b2].tolist()
+    block_lines = block_lines[b1:b2 + 1].tolist()
+    flow_blocks = flow_blocks[f1:f2 + 1].tolist()
+
+    page = {'page': []}
+    for f in range(f2 - f1):
+        flow = {'flow': []}
+        for b in range(flow_blocks[f], flow_blocks[f + 1]):
+            block = {'block': [], 'bbox': block_bbox[b - b1]}
+            for l in range(block_lines[b - b1] - l1, block_lines[b - b1 + 1] - l1):
+                block['block'].append({'line': text[lines[l]:lines[l + 1]].decode('utf-8'), 'bbox': line_bbox[l]})
+            flow['flow'].append(block)
+        page['page'].append(flow)
+    return page
+
+
+npy_headers = {(1, 0): np.lib.format.read_array_header_1_0,
+               (2, 0): np.lib.format.read_array_header_2_0}
+
+
+def open_npz(path):
+    """
+    Returns the arrays of a `.npz` file, members stored without compression (np.savez) are
+    memory-mapped instead of read. Other members are read whole.
+    """
+    arrays = {}
+    with open(path, 'rb') as f, zipfile.ZipFile(f) as npz:
+        for info in npz.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type == zipfile.ZIP_STORED:
+                # Data of the member starts after its local header, which has its own name and extra field.
+                f.seek(info.header_offset + 26)
+                name_size, extra_size = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + name_size + extra_size)
+                read_header = npy_headers.get(np.lib.format.read_magic(f))
+                if read_header is not None:
+                    shape, fortran_order, dtype = read_header(f)
+                    if not dtype.hasobject and np.prod(shape) > 0:
+                        arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                                 order='F' if fortran_order else 'C')
+                        continue
+            with npz.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+
+def npz_to_json(arrays):
+    """
+    Rebuilds the json structure of pdf2txt from the arrays of a `.npz` layout.
+    """
+    arrays = {name: arrays[name] for name in arrays.files} if hasattr(arrays, 'files') else arrays
+    return [npz_page(arrays, p) for p in range(len(arrays['page_flows']) - 1)]
+
+
+def read_layout(path):
+    """
+    Reads a layout written by pdf2txt in any format and returns the json structure.
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as arrays:
+            return npz_to_json(arrays)
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            return [ujson.loads(line) for line in f]
+    with open(path) as f:
+        return ujson.load(f)
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def build_index(path):
+    """
+    Page index of an output written without one: lines of jsonl, form feed separated pages of txt.
+    Json has no byte ranges without parsing and returns None.
+    """
+    if path.endswith('.jsonl'):
+        pages = []
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                pages.append((offset, offset + len(line)))
+                offset += len(line)
+        return np.array(pages, dtype=np.int64).reshape(-1, 2)
+    if path.endswith('.txt'):
+        pages = []
+        offset = 0
+        with open(path, 'rb') as f:
+            for page in f.read().split(b'\f'):
+                pages.append((offset, offset + len(page)))
+                offset += len(page) + 1
+        return np.array(pages, dtype=np.int64).reshape(-1, 2)
+    return None
+
+
+class PageReader:
+    """
+    Random access to pages of converted papers in `storage`:
+
+        reader = PageReader(storage)
+        first = reader.read_page('2101.00001v1', 0)
+        for page in reader.iter_pages('2101.00001v1', pages=range(3)): ...
+
+    Papers are named like their pdf (with version); with a `catalog` unversioned arxiv ids are
+    resolved to the converted file. Pages of json/jsonl are returned as dicts of the json output,
+    pages of txt as strings. Files are read through mmap, only the bytes of requested pages are touched.
+    """
+    formats = ('npz', 'jsonl', 'json', 'txt')
+
+    def __init__(self, storage, catalog=None, formats=None):
+        self.storage = storage
+        self.catalog = catalog
+        self.formats = formats or self.formats
+
+    def find(self, arxiv_id):
+        if self.catalog is not None:
+            name = self.catalog.layout_name(arxiv_id)
+            if name is not None:
+                paper, kind = name.rsplit('.', 1)
+                return self.storage.path(paper, kind)
+        for kind in self.formats:
+            path = self.storage.path(arxiv_id, kind)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError('No converted layout of %s' % arxiv_id)
+
+    def read_page(self, arxiv_id, n):
+        for page in self.iter_pages(arxiv_id, [n]):
+            return page
+
+    def iter_pages(self, arxiv_id, pages=None):
+        """
+        Yields pages with numbers in `pages` (all pages by default) in the given order.
+        """
+        path = self.find(arxiv_id)
+        if path.endswith('.npz'):
+            arrays = open_npz(path)
+            count = len(arrays['page_flows']) - 1
+            for n in (range(count) if pages is None else pages):
+                if not 0 <= n < count:
+                    raise IndexError('%s has %d pages' % (arxiv_id, count))
+                yield npz_page(arrays, n)
+            return
+
+        if os.path.exists(index_path(path)):
+            index = np.load(index_path(path))
+        else:
+            index = build_index(path)
+        if index is None:
+            layout = read_layout(path)
+            for n in (range(len(layout)) if pages is None else pages):
+                yield layout[n]
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                for n in (range(len(index)) if pages is None else pages):
+                    if not 0 <= n < len(index):
+                        raise IndexError('%s has %d pages' % (arxiv_id, len(index)))
+                    start, end = index[n].tolist()
+                    page = data[start:end].decode('utf-8')
+                    yield page if path.endswith('.txt') else ujson.loads(page)
+            finally:
+                if size:
+                    data.close()
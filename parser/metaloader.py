@@ -4,43 +4,170 @@ import logging
 import argparse
 from utils import setup_logging
 from utils import download
+from utils import atomic_open
+from utils import make_session
+from utils import host_limiter
+from utils import RateLimiter
+from utils import request_interval
+from utils import url
+from utils import OAIError
 import os
 import json
-from mmh3 import hash
+import queue
+import threading
+from metastore import open_meta_store
+from catalog import Catalog
 
 
 logger = logging.getLogger(__name__)
 
 
-def load_meta(arx_path, seed):
-    for data in download():
-        for sample in data:
-            try:
-                path = os.path.join(arx_path, str(hash(sample.arxiv_id, seed) % 500), sample.arxiv_id)
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                filename = os.path.join(path, "{0}".format(sample.arxiv_id))
-                if not os.path.exists(filename):
-                    with open(filename, "w") as f:
-                        json.dump({'date': sample.date,
-                                   'id': sample.arxiv_id,
-                                   'title': sample.title,
-                                   'abstract': sample.abstract,
-                                   'categories': sample.categories}, f, indent=4)
-            except Exception as e:
-                logger.info('{0}'.format(e))
+def new_stream_state():
+    return {'from': None, 'token': None, 'last_datestamp': None}
+
+
+def read_state(state_path):
+    """
+    Harvest state of every stream, keyed by OAI set ('all' - the whole archive): `from` - date for
+    the next incremental harvest, `token` - resumption token of an unfinished harvest,
+    `last_datestamp` - latest datestamp of harvested records.
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        state = json.load(f)
+    # Checkpoint of a single-stream harvest.
+    if 'token' in state:
+        state = {'all': state}
+    return state
+
+
+def write_state(state, state_path):
+    with atomic_open(state_path) as f:
+        json.dump(state, f, indent=4)
+
+
+def harvest_stream(name, state, merged, session, limiter, base_url=url):
+    """
+    Puts (name, records, token) of every page of one stream to `merged` and None at the end.
+    A rejected resumption token is reported as (name, None, None).
+    """
+    set_spec = None if name == 'all' else name
+    try:
+        if state['token'] is not None:
+            logger.info('{0}: resuming unfinished harvest...'.format(name))
+            pages = download(resumption_token=state['token'], set_spec=set_spec, base_url=base_url,
+                             session=session, limiter=limiter)
+        else:
+            logger.info('{0}: harvesting records since {1}...'.format(name, state['from'] or 'the beginning'))
+            pages = download(start_date=state['from'], set_spec=set_spec, base_url=base_url,
+                             session=session, limiter=limiter)
+        for data, token in pages:
+            merged.put((name, data, token))
+    except Exception as e:
+        logger.error('{0}: {1}'.format(name, e))
+        if isinstance(e, OAIError) and e.code == 'badResumptionToken':
+            merged.put((name, None, None))
+    finally:
+        merged.put(None)
+
+
+def load_meta(storage, catalog, state_path, sets=None, full=False, interval=request_interval,
+              per_stream_limit=False, base_url=url):
+    """
+    Harvests every set in `sets` (or the whole archive) as an independent stream. Streams share one
+    pooled session; their pages are written by this thread only, records of a paper listed in
+    several sets are written once per run.
+
+    By default all streams share the rate limiter of the host, so together they send no more
+    requests than one stream: the gain is only that one stream's request waits on the server while
+    pages of other streams are parsed and written. With `per_stream_limit` every stream waits
+    `interval` on its own, which is faster only where the provider allows that rate per harvest.
+    Sets overlap (cross-listed papers), so streams also download some records more than once.
+    """
+    names = sets or ['all']
+    state = {} if full else read_state(state_path)
+    for name in names:
+        state.setdefault(name, new_stream_state())
+
+    session = make_session(len(names))
+    limiter = None if per_stream_limit else host_limiter(base_url, interval)
+    merged = queue.Queue(maxsize=2 * len(names))
+    for name in names:
+        threading.Thread(target=harvest_stream,
+                         args=(name, dict(state[name]), merged, session,
+                               limiter or RateLimiter(interval), base_url),
+                         daemon=True).start()
+
+    seen = set()
+    completed = set()
+    running = len(names)
+    while running:
+        page = merged.get()
+        if page is None:
+            running -= 1
+            continue
+        name, data, token = page
+        stream = state[name]
+        if data is None:
+            # Other failures keep the token, so the next run resumes the harvest where it stopped.
+            logger.warning('{0}: resumption token is not accepted, next run starts from {1}.'.format(
+                name, stream['from']))
+            stream['token'] = None
+            write_state(state, state_path)
+            continue
+        with catalog.transaction():
+            for sample in data:
+                try:
+                    if sample.arxiv_id not in seen:
+                        size = storage.put_meta(sample.arxiv_id, {'date': sample.date,
+                                                                  'id': sample.arxiv_id,
+                                                                  'title': sample.title,
+                                                                  'abstract': sample.abstract,
+                                                                  'categories': sample.categories})
+                        catalog.update_meta(sample.arxiv_id, sample.date, sample.categories, size)
+                        if len(names) > 1:
+                            seen.add(sample.arxiv_id)
+                    if sample.datestamp is not None and (stream['last_datestamp'] is None
+                                                         or sample.datestamp > stream['last_datestamp']):
+                        stream['last_datestamp'] = sample.datestamp
+                except Exception as e:
+                    logger.info('{0}'.format(e))
+        stream['token'] = token or None
+        if token == '':
+            completed.add(name)
+            stream['from'] = stream['last_datestamp'] or stream['from']
+        write_state(state, state_path)
+    return len(completed) == len(names)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log',
                         help='log filename')
-    parser.add_argument('--seed', default=42,
+    parser.add_argument('--seed', default=42, type=int,
                         help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of hash folders in arxiv dir.')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Set logger mode to debug.')
     parser.add_argument('--arxiv-dir', default='arxiv',
                         help='Folder name where the final result will be stored.')
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog filename (default: catalog.sqlite in arxiv dir), keep it on local disk '
+                             'if arxiv dir is on NFS.')
+    parser.add_argument('--state', default=None,
+                        help='Harvest checkpoint filename (default: harvest_state.json in arxiv dir).')
+    parser.add_argument('--full', default=False, action='store_true',
+                        help='Ignore the checkpoint and harvest all records.')
+    parser.add_argument('--sets', default=None, nargs='+',
+                        help='OAI sets harvested as parallel streams, e.g. physics math cs (default: whole archive).')
+    parser.add_argument('--meta-store', default='files', choices=['files', 'packed'],
+                        help='files - json file per paper, packed - per-shard segments in arxiv dir/meta.')
+    parser.add_argument('--interval', default=request_interval, type=float,
+                        help='Minimal pause in seconds between requests to the OAI host, shared by all streams.')
+    parser.add_argument('--per-stream-limit', default=False, action='store_true',
+                        help='Apply --interval to every set stream separately instead of the whole host.')
     args = parser.parse_args()
 
     if not os.path.exists(args.arxiv_dir):
@@ -49,5 +176,14 @@ if __name__ == '__main__':
     setup_logging(logger, args)
 
     logger.info('Loading meta...')
-    load_meta(args.arxiv_dir, args.seed)
-    logger.info('Meta download completed successfully!')
+    completed = load_meta(open_meta_store(args.meta_store, args.arxiv_dir, args.seed, args.shards),
+                          Catalog(args.catalog or os.path.join(args.arxiv_dir, 'catalog.sqlite')),
+                          args.state or os.path.join(args.arxiv_dir, 'harvest_state.json'),
+                          args.sets,
+                          args.full,
+                          args.interval,
+                          args.per_stream_limit)
+    if completed:
+        logger.info('Meta download completed successfully!')
+    else:
+        logger.warning('Meta download stopped before the end, next run resumes it.')
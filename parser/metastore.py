@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import os
+import json
+import fcntl
+import logging
+import argparse
+from mmh3 import hash
+from utils import setup_logging
+from utils import atomic_open
+from utils import Meta
+from storage import ShardedStorage
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class PackedMetaStore:
+    """
+    Meta of papers packed into per-shard segments: <root>/<shard>.jsonl holds one json record per
+    line, <root>/<shard>.idx holds "arxiv_id<TAB>offset" lines. Updates are appended, the latest
+    offset of an id wins, `compact` drops the replaced records. Shard is mmh3(paper, seed) % shards,
+    like in ShardedStorage.
+
+    Indexes are loaded per shard on first access. The store keeps no open files, so it can be passed
+    to worker processes. Appends and `compact` of a shard hold an exclusive lock on <root>/<shard>.lock,
+    so compaction can run while metaloader is writing. `get_meta` reloads the index of a shard that
+    was compacted since it was loaded.
+    """
+    def __init__(self, root, seed=42, shards=500):
+        self.root = root
+        self.seed = seed
+        self.shards = shards
+        self.indexes = {}
+        os.makedirs(root, exist_ok=True)
+
+    def shard(self, paper):
+        return str(hash(paper, self.seed) % self.shards)
+
+    def segment_path(self, shard):
+        return os.path.join(self.root, shard + '.jsonl')
+
+    def index_path(self, shard):
+        return os.path.join(self.root, shard + '.idx')
+
+    @contextmanager
+    def locked(self, shard):
+        with open(os.path.join(self.root, shard + '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def index(self, shard):
+        index = self.indexes.get(shard)
+        if index is None:
+            index = self.indexes[shard] = {}
+            if os.path.exists(self.index_path(shard)):
+                with open(self.index_path(shard)) as f:
+                    for line in f:
+                        # Lines torn by an interrupted write are skipped.
+                        parts = line.rstrip('\n').split('\t')
+                        if len(parts) == 2 and parts[1].isdigit():
+                            index[parts[0]] = int(parts[1])
+        return index
+
+    def put_meta(self, paper, meta):
+        """
+        Returns size of the written record.
+        """
+        shard = self.shard(paper)
+        index = self.index(shard)
+        data = (json.dumps(meta) + '\n').encode('utf-8')
+        with self.locked(shard):
+            with open(self.segment_path(shard), 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            with open(self.index_path(shard), 'a') as f:
+                f.write('%s\t%d\n' % (paper, offset))
+        index[paper] = offset
+        return len(data)
+
+    def get_meta(self, paper):
+        shard = self.shard(paper)
+        for attempt in range(2):
+            offset = self.index(shard).get(paper)
+            if offset is None:
+                return None
+            with open(self.segment_path(shard), 'rb') as f:
+                f.seek(offset)
+                line = f.readline()
+            try:
+                meta = json.loads(line)
+                if meta.get('id') == paper:
+                    return meta
+            except ValueError:
+                pass
+            # The shard was compacted after its index was loaded, offsets have moved.
+            self.indexes.pop(shard, None)
+        raise ValueError('%s: record is not found at the indexed offset of shard %s' % (paper, shard))
+
+    def exists(self, paper, kind='meta'):
+        """
+        Same signature as `ShardedStorage.exists`, the store holds only meta.
+        """
+        return kind == 'meta' and paper in self.index(self.shard(paper))
+
+    def segments(self):
+        return sorted(name[:-len('.jsonl')] for name in os.listdir(self.root) if name.endswith('.jsonl'))
+
+    def iter_records(self, shard):
+        """
+        Yields (arxiv_id, meta, size) of the latest records of one shard in the order of the segment.
+        """
+        index = self.index(shard)
+        with open(self.segment_path(shard), 'rb') as f:
+            for paper, offset in sorted(index.items(), key=lambda item: item[1]):
+                f.seek(offset)
+                line = f.readline()
+                yield paper, json.loads(line), len(line)
+
+    def compact(self, shard):
+        """
+        Rewrites a segment with the latest record of every paper. Returns count of dropped records.
+        """
+        with self.locked(shard):
+            # Records appended by other processes are only in the index file.
+            self.indexes.pop(shard, None)
+            with open(self.segment_path(shard), 'rb') as f:
+                count = sum(1 for line in f)
+            new_index = {}
+            with atomic_open(self.segment_path(shard), 'wb') as f:
+                for paper, meta, size in self.iter_records(shard):
+                    new_index[paper] = f.tell()
+                    f.write((json.dumps(meta) + '\n').encode('utf-8'))
+            with atomic_open(self.index_path(shard)) as f:
+                for paper, offset in new_index.items():
+                    f.write('%s\t%d\n' % (paper, offset))
+            self.indexes[shard] = new_index
+        return count - len(new_index)
+
+    def read_meta(self, paper):
+        """
+        Returns the record of a paper as `utils.Meta`, or None.
+        """
+        meta = self.get_meta(paper)
+        if meta is None:
+            return None
+        return to_meta(meta)
+
+    def iter_meta(self):
+        """
+        Yields `utils.Meta` of every paper in the store.
+        """
+        for shard in self.segments():
+            for paper, meta, size in self.iter_records(shard):
+                yield to_meta(meta)
+
+
+def to_meta(meta):
+    return Meta(meta['id'], meta['date'], meta['title'], meta['abstract'], meta['categories'])
+
+
+def open_meta_store(kind, arxiv_dir, seed=42, shards=500):
+    """
+    Meta store of an arxiv dir: 'files' - one json file per paper in the paper folder,
+    'packed' - segments in <arxiv_dir>/meta.
+    """
+    if kind == 'packed':
+        return PackedMetaStore(os.path.join(arxiv_dir, 'meta'), seed, shards)
+    return ShardedStorage(arxiv_dir, seed, shards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['compact'],
+                        help='compact - drop replaced records from the segments.')
+    parser.add_argument('--log',
+                        help='Log filename.')
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='Set logger mode to debug.')
+    parser.add_argument('--arxiv-dir', default='arxiv',
+                        help='Folder name where papers(meta, txt, pdf) are stored.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of meta segments.')
+    args = parser.parse_args()
+
+    setup_logging(logger, args)
+
+    store = open_meta_store('packed', args.arxiv_dir, args.seed, args.shards)
+    logger.info('Compacting meta segments...')
+    dropped = sum(store.compact(shard) for shard in store.segments())
+    logger.info('Compaction is done! %d replaced records dropped.' % dropped)
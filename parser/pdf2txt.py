@@ -2,102 +2,400 @@
 
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
+from watchdog.events import FileCreatedEvent
 import logging
 import argparse
 import os
 import shutil
 from utils import setup_logging
-from mmh3 import hash
+from storage import ShardedStorage
+from catalog import Catalog
+from utils import paper_id
 import pdfparser.poppler as pdf
+import pdftotext
 import ujson
+from utils import atomic_open
+from layout import LayoutBuilder, JsonWriter, JsonlWriter, TextWriter, index_path
+from convcache import ConversionCache, file_digest
 from tqdm.auto import tqdm
 import time
+import multiprocessing as mp
+import multiprocessing.connection
+import threading
+import signal
+import resource
+import tempfile
+import queue
 
 
 logger = logging.getLogger(__name__)
+# Bump when the output of the converters changes, cached outputs of other versions are evicted.
+CONVERTER_VERSION = '1'
 
 
-def pdf_convert(src_dir, dst_dir):
+def pdf_convert(src_dir, dst_dir, fmt='json'):
     try:
         if os.stat(src_dir).st_size == 0:
             time.sleep(5)
             if os.stat(src_dir).st_size == 0:
                 return
-        txt = []
         file_name = bytes(src_dir, "utf-8")
         d = pdf.Document(file_name, False)
-        for p in d:
-            page = {'page': []}
-            for f in p:
-                flow = {'flow': []}
-                for b in f:
-                    block = {'block': [], 'bbox': b.bbox.as_tuple()}
-                    for l in b:
-                        block['block'].append({'line': l.text, 'bbox': l.bbox.as_tuple()})
-                    flow['flow'].append(block)
-                page['page'].append(flow)
-            txt.append(page)
-        with open(dst_dir, 'w') as f:
-            ujson.dump(txt, f, indent=4, ensure_ascii=False)
+        if fmt == 'npz':
+            builder = LayoutBuilder()
+            for p in d:
+                for f in p:
+                    for b in f:
+                        for l in b:
+                            builder.add_line(l.text, l.bbox.as_tuple())
+                        builder.end_block(b.bbox.as_tuple())
+                    builder.end_flow()
+                builder.end_page()
+            with atomic_open(dst_dir, 'wb') as f:
+                builder.save(f)
+            return len(builder.page_flows) - 1
+
+        # Every page is written as soon as poppler yields it, so only one page is kept in memory.
+        with atomic_open(dst_dir, 'wb') as out:
+            writer = JsonlWriter(out) if fmt == 'jsonl' else JsonWriter(out)
+            for p in d:
+                page = {'page': []}
+                for f in p:
+                    flow = {'flow': []}
+                    for b in f:
+                        block = {'block': [], 'bbox': b.bbox.as_tuple()}
+                        for l in b:
+                            block['block'].append({'line': l.text, 'bbox': l.bbox.as_tuple()})
+                        flow['flow'].append(block)
+                    page['page'].append(flow)
+                writer.write_page(page)
+            writer.close()
+        with atomic_open(index_path(dst_dir), 'wb') as f:
+            writer.save_index(f)
+        return writer.count
+    except MemoryError:
+        raise
     except Exception as e:
-        logger.error('Impossible convert %s to txt!' % filename)
+        logger.error('Impossible convert %s to txt! %s' % (src_dir, e))
+
+
+def pdf_extract_text(src_dir, dst_dir):
+    """
+    Plain text without layout through pdftotext, pages are separated by form feed ('\\f').
+    """
+    try:
+        with open(src_dir, 'rb') as f:
+            pages = pdftotext.PDF(f)
+        with atomic_open(dst_dir, 'wb') as out:
+            writer = TextWriter(out)
+            for page in pages:
+                writer.write_page(page)
+            writer.close()
+        with atomic_open(index_path(dst_dir), 'wb') as f:
+            writer.save_index(f)
+        return len(pages)
+    except MemoryError:
+        raise
+    except Exception as e:
+        logger.error('Impossible extract text from %s! %s' % (src_dir, e))
+
+
+def convert_cached(cache, digest, kind, convert, src_path, dst_path, indexed=True):
+    """
+    Output and its page index are cached together, an entry without index is converted again.
+    """
+    outputs = [(kind, dst_path)] + ([(kind + '.idx', index_path(dst_path))] if indexed else [])
+    if cache is not None and cache.fetch_all([(cache.key(digest, k), path) for k, path in outputs]):
+        return
+    convert(src_path, dst_path)
+    if cache is not None:
+        for k, path in outputs:
+            cache.store(cache.key(digest, k), path)
 
 
-def pdf_to_text(pdf, txt, seed):
+def pdf_to_text(pdf, storage, fmt='json', mode='layout', cache=None):
+    """
+    Returns path of the output recorded in the catalog: the layout, or the plain text in mode 'text'.
+    """
     filename = (pdf.split('/')[-1])[:-4]
-    if not os.path.exists(txt + '/' + str(hash(filename, seed)%500)):
-        os.mkdir(txt + '/' + str(hash(filename, seed) % 500))
     try:
-        txt_path = txt + '/' + str(hash(filename, seed) % 500) + '/' + filename + '/' + filename + '.json'
-        if not os.path.exists(txt + '/' + str(hash(filename, seed) % 500) + '/' + filename):
-            os.mkdir(txt + '/' + str(hash(filename, seed) % 500) + '/' + filename)
-        pdf_convert(pdf, txt_path)
+        digest = file_digest(pdf) if cache is not None else None
+        layout_path = None
+        if mode in ('layout', 'both'):
+            layout_path = storage.path(filename, fmt, create=True)
+            convert_cached(cache, digest, fmt, lambda src, dst: pdf_convert(src, dst, fmt), pdf, layout_path,
+                           indexed=fmt != 'npz')
+        if mode in ('text', 'both'):
+            txt_path = storage.path(filename, 'txt', create=True)
+            convert_cached(cache, digest, 'txt', pdf_extract_text, pdf, txt_path)
         logger.debug('%s converted.' % filename)
-        return txt_path
+        return layout_path or txt_path
+    except MemoryError:
+        raise
     except Exception as e:
         logger.error('Impossible convert %s to txt!' % filename)
 
 
-def closed(arx_path, seed):
-    arx_dir = arx_path
-    seed = seed
+def process_pdf(pdf_path, storage, fmt='json', mode='layout', cache=None, catalog=None):
+    txt_path = pdf_to_text(pdf_path, storage, fmt, mode, cache)
+    filename = (pdf_path.split('/')[-1])[:-4]
+    stored_path = storage.put_file(filename, 'pdf', pdf_path)
+    if catalog is not None:
+        with catalog.transaction():
+            catalog.update_pdf(paper_id(filename), os.path.split(stored_path)[1], os.path.getsize(stored_path))
+            if txt_path is not None and os.path.exists(txt_path):
+                catalog.update_layout(paper_id(filename), os.path.split(txt_path)[1], os.path.getsize(txt_path))
 
-    def on_created(event):
-        if event.src_path.split('/')[-1] not in old_files and os.path.exists(event.src_path):
+
+def worker(tasks, conn, storage, fmt='json', mode='layout', cache_path=None, catalog_path=None, timeout=None,
+           memory_limit=None, max_tasks=None):
+    """
+    Converts pdfs from `tasks` and reports every document to the pool through `conn`. Exits after
+    `max_tasks` documents, so leaks of the poppler extension are capped.
+    """
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    # Default action of SIGALRM kills the process, even if poppler hangs inside C code.
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    # Ctrl-C reaches the whole process group, the pool stops workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cache = ConversionCache(cache_path, CONVERTER_VERSION) if cache_path else None
+    catalog = Catalog(catalog_path) if catalog_path else None
+
+    done = 0
+    while max_tasks is None or done < max_tasks:
+        pdf_path = tasks.get()
+        if pdf_path is None:
+            break
+        if not os.path.exists(pdf_path):
+            continue
+        conn.send(('start', pdf_path))
+        hits = cache.hits if cache is not None else 0
+        if timeout:
+            signal.alarm(timeout)
+        try:
+            process_pdf(pdf_path, storage, fmt, mode, cache, catalog)
+        except MemoryError:
+            conn.send(('failed', pdf_path, 'memory limit exceeded'))
+            break
+        except Exception as e:
+            logger.error(e)
+        finally:
+            signal.alarm(0)
+        conn.send(('done', pdf_path, cache is not None and cache.hits > hits))
+        done += 1
+
+
+class WorkerPool:
+    """
+    Keeps `count` worker processes converting pdfs from `tasks`. A worker that dies in the middle of
+    a document (timeout, memory limit, crash in poppler) is replaced, and the document is moved to
+    `quarantine_dir` with the reason, so it isn't retried on every start.
+    """
+    def __init__(self, tasks, count, storage, quarantine_dir, fmt='json', mode='layout', cache_path=None,
+                 catalog_path=None, timeout=None, memory_limit=None, max_tasks=None, report_every=1000):
+        self.tasks = tasks
+        self.count = count
+        self.worker_args = (storage, fmt, mode, cache_path, catalog_path, timeout, memory_limit, max_tasks)
+        self.cache_path = cache_path
+        self.report_every = report_every
+        self.converted = 0
+        self.cached = 0
+        self.quarantine_dir = quarantine_dir
+        self.timeout = timeout
+        self.workers = {}
+        self.current = {}
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        for _ in range(self.count):
+            self.spawn()
+        self.thread.start()
+
+    def drain(self):
+        try:
+            while True:
+                # Items put just now may still be in the feeder thread of the queue.
+                self.tasks.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+    def stop(self):
+        """
+        Drops queued pdfs (they stay in the tasks dir for the next start), lets workers finish their
+        current document and terminates workers that are still busy after the timeout.
+        """
+        self.stopping = True
+        self.drain()
+        sent = 0
+        while sent < len(self.workers):
+            try:
+                self.tasks.put_nowait(None)
+                sent += 1
+            except queue.Full:
+                self.drain()
+                sent = 0
+        self.thread.join(self.timeout or 60)
+        for process in list(self.workers):
+            process.terminate()
+        self.thread.join()
+
+    def spawn(self):
+        reader, writer = mp.Pipe(duplex=False)
+        process = mp.Process(target=worker, args=(self.tasks, writer) + self.worker_args, daemon=True)
+        process.start()
+        writer.close()
+        self.workers[process] = reader
+
+    def quarantine(self, pdf_path, reason):
+        logger.error('%s quarantined: %s' % (pdf_path, reason))
+        name = os.path.split(pdf_path)[1]
+        # A pdf with the same name may be quarantined already.
+        dst_path = os.path.join(self.quarantine_dir, name)
+        i = 1
+        while os.path.exists(dst_path):
+            dst_path = os.path.join(self.quarantine_dir, '%s.%d' % (name, i))
+            i += 1
+        if os.path.exists(pdf_path):
+            shutil.move(pdf_path, dst_path)
+        with open(os.path.join(self.quarantine_dir, 'reasons.jsonl'), 'a') as f:
+            f.write(ujson.dumps({'file': os.path.split(dst_path)[1], 'reason': reason,
+                                 'time': time.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+
+    def handle(self, process, message):
+        if message[0] == 'start':
+            self.current[process] = (message[1], time.time())
+        elif message[0] == 'done':
+            self.current.pop(process, None)
+            self.converted += 1
+            self.cached += message[2]
+            if self.cache_path and self.converted % self.report_every == 0:
+                self.report()
+        elif message[0] == 'failed':
+            self.current.pop(process, None)
+            self.quarantine(message[1], message[2])
+
+    def report(self):
+        count, size = ConversionCache(self.cache_path, CONVERTER_VERSION).stats()
+        logger.info('Conversion cache: %d entries (%.1f MB), hit rate %.1f%% (%d of %d pdfs)'
+                    % (count, size / 1024 / 1024, 100 * self.cached / self.converted, self.cached, self.converted))
+
+    def reap(self, process):
+        del self.workers[process]
+        if process in self.current and self.stopping:
+            # Terminated on stop, the pdf stays in the tasks dir.
+            self.current.pop(process)
+        elif process in self.current:
+            pdf_path, _ = self.current.pop(process)
+            if process.exitcode == -signal.SIGALRM:
+                reason = 'timeout after %ds' % self.timeout
+            elif process.exitcode == -signal.SIGKILL:
+                reason = 'killed (timeout or out of memory)'
+            elif process.exitcode < 0:
+                reason = 'crashed with signal %d' % -process.exitcode
+            else:
+                reason = 'worker exited with code %d' % process.exitcode
             try:
-                pdf_to_text(event.src_path, arx_dir, seed)
-                filename = (event.src_path.split('/')[-1])[:-4]
-                shutil.move(event.src_path, arx_dir + '/' + str(hash(filename, seed) % 500) + '/' + (filename))
+                self.quarantine(pdf_path, reason)
             except Exception as e:
-                logger.error(e)
+                # The supervisor must keep running, otherwise dead workers are never replaced.
+                logger.error('Quarantine of %s failed: %s' % (pdf_path, e))
+        if not self.stopping:
+            self.spawn()
+
+    def run(self):
+        while self.workers:
+            mp.connection.wait(list(self.workers.values()) + [p.sentinel for p in self.workers], timeout=1)
+            for process, reader in list(self.workers.items()):
+                try:
+                    while reader.poll():
+                        self.handle(process, reader.recv())
+                except EOFError:
+                    pass
+                except Exception as e:
+                    logger.error('Handling message of worker %d failed: %s' % (process.pid, e))
+                if not process.is_alive():
+                    process.join()
+                    self.reap(process)
+                elif self.timeout and process in self.current \
+                        and time.time() - self.current[process][1] > 2 * self.timeout:
+                    # Alarm didn't fire (e.g. signals blocked by the extension), kill from outside.
+                    process.kill()
+
+
+def benchmark(pdf_paths, fmt='json'):
+    """
+    Converts `pdf_paths` to a temporary folder in both modes and logs pages per second of each.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, convert, ext in (('layout', lambda src, dst: pdf_convert(src, dst, fmt), fmt),
+                                   ('text', pdf_extract_text, 'txt')):
+            pages = 0
+            start = time.time()
+            for i, pdf_path in enumerate(pdf_paths):
+                pages += convert(pdf_path, os.path.join(tmp_dir, '%d.%s' % (i, ext))) or 0
+            elapsed = time.time() - start
+            logger.info('%s mode: %d pdfs, %d pages in %.1fs (%.1f pages/s)'
+                        % (mode, len(pdf_paths), pages, elapsed, pages / max(elapsed, 1e-6)))
+
+
+def closed(tasks, old_files):
+    def on_created(event):
+        # Blocks the observer thread while the queue is full, so new files wait for free workers.
+        if event.src_path.split('/')[-1] not in old_files and os.path.exists(event.src_path):
+            tasks.put(event.src_path)
 
     return on_created
 
 
-def convert_old(src_dir, dst_dir, list, seed):
+def convert_old(tasks, src_dir, list):
     for pdf_file in tqdm(list, desc='Converting old files'):
-        filename = os.path.join(src_dir, pdf_file)
-        if os.path.exists(filename):
-            try:
-                pdf_to_text(filename, dst_dir, seed)
-                dirname = (filename.split('/')[-1])[:-4]
-                shutil.move(filename, dst_dir + '/' + str(hash(dirname, seed) % 500) + '/' + (dirname))
-            except Exception as e:
-                print(e)
+        tasks.put(os.path.join(src_dir, pdf_file))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log',
                         help='Log filename.')
-    parser.add_argument('--seed', default=42,
+    parser.add_argument('--seed', default=42, type=int,
                         help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of hash folders in arxiv dir.')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Set logger mode to debug.')
     parser.add_argument('--tasks-dir', default='pdf',
                         help='Folder name where tasks are stored for converting to txt')
     parser.add_argument('--arxiv-dir', default='arxiv',
                         help='Folder name where the final result will be stored.')
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int,
+                        help='Count of worker processes converting pdfs.')
+    parser.add_argument('--queue-size', default=64, type=int,
+                        help='Max count of pdfs waiting for a free worker.')
+    parser.add_argument('--timeout', default=300, type=int,
+                        help='Max seconds for converting one pdf (0 - no limit).')
+    parser.add_argument('--memory-limit', default=4096, type=int,
+                        help='Max address space of a worker in MB (0 - no limit).')
+    parser.add_argument('--max-tasks', default=500, type=int,
+                        help='Count of pdfs after which a worker is restarted (0 - never).')
+    parser.add_argument('--quarantine-dir', default='quarantine',
+                        help='Folder name where pdfs that failed conversion are moved.')
+    parser.add_argument('--format', default='json', choices=['json', 'jsonl', 'npz'],
+                        help='Output format of the layout: json, json lines (one page per line) '
+                             'or compact npz arrays (see layout.py).')
+    parser.add_argument('--mode', default='layout', choices=['layout', 'text', 'both'],
+                        help='layout - poppler layout with bboxes, text - plain text through pdftotext, '
+                             'both - layout and text.')
+    parser.add_argument('--cache-path', default=None,
+                        help='Conversion cache index (default: conversion_cache.sqlite in arxiv dir), keep it on local '
+                             'disk if arxiv dir is on NFS.')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='Convert every pdf even if an identical one was converted before.')
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog filename (default: catalog.sqlite in arxiv dir), keep it on local disk '
+                             'if arxiv dir is on NFS.')
+    parser.add_argument('--benchmark', default=None, type=int,
+                        help='Compare pages/s of layout and text modes on this count of pdfs from tasks dir and exit.')
     args = parser.parse_args()
 
     setup_logging(logger, args)
@@ -106,28 +404,56 @@ if __name__ == '__main__':
         os.mkdir(args.tasks_dir)
     if not os.path.exists(args.arxiv_dir):
         os.mkdir(args.arxiv_dir)
+    if not os.path.exists(args.quarantine_dir):
+        os.mkdir(args.quarantine_dir)
+
+    old_files = [name for name in os.listdir(args.tasks_dir) if not name.endswith('.tmp')]
 
-    old_files = os.listdir(args.tasks_dir)
+    if args.benchmark is not None:
+        benchmark([os.path.join(args.tasks_dir, name) for name in old_files[:args.benchmark]], args.format)
+        exit(0)
+
+    cache_path = None
+    if not args.no_cache:
+        cache_path = args.cache_path or os.path.join(args.arxiv_dir, 'conversion_cache.sqlite')
+        evicted = ConversionCache(cache_path, CONVERTER_VERSION).evict()
+        if evicted:
+            logger.info('%d cache entries of old converter versions evicted' % evicted)
+
+    tasks = mp.Queue(maxsize=args.queue_size)
+    storage = ShardedStorage(args.arxiv_dir, args.seed, args.shards)
+    pool = WorkerPool(tasks, args.workers, storage, args.quarantine_dir,
+                      fmt=args.format,
+                      mode=args.mode,
+                      cache_path=cache_path,
+                      catalog_path=args.catalog or os.path.join(args.arxiv_dir, 'catalog.sqlite'),
+                      timeout=args.timeout or None,
+                      memory_limit=args.memory_limit * 1024 * 1024 or None,
+                      max_tasks=args.max_tasks or None)
+    pool.start()
 
     path = args.tasks_dir
     patterns = "*"
-    ignore_patterns = ""
+    ignore_patterns = ["*.tmp"]
     ignore_directories = True
     case_sensitive = True
     event_handler = PatternMatchingEventHandler(patterns, ignore_patterns, ignore_directories, case_sensitive)
 
-    event_handler.on_created = closed(args.arxiv_dir, args.seed)
+    event_handler.on_created = closed(tasks, set(old_files))
+    # Files are written atomically (tmp + rename), so finished files arrive as moves.
+    event_handler.on_moved = lambda event: event_handler.on_created(FileCreatedEvent(event.dest_path))
 
     go_recursively = True
     observer = Observer()
     observer.schedule(event_handler, path, recursive=go_recursively)
     observer.start()
 
-    convert_old(args.tasks_dir, args.arxiv_dir, old_files, args.seed)
-
     try:
-        while True:
-            pass
+        convert_old(tasks, args.tasks_dir, old_files)
+        observer.join()
     except KeyboardInterrupt:
-        observer.stop()
+        pass
+    observer.stop()
+    # Stopping the pool drains the queue, so the observer isn't blocked on a full queue when joined.
+    pool.stop()
     observer.join()
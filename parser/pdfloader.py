@@ -4,19 +4,29 @@ import boto
 import logging
 import argparse
 from utils import setup_logging
+from tar2pdf import extract_members
+from tar2pdf import forget_extracted
+from tar2pdf import ledger_name
 from lxml import etree
 import shutil
 import configparser
 from tqdm import tqdm
 import time
+import hashlib
+import json
+import tarfile
+import tempfile
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 
 def read_manifest(manifest_filename):
     manifest_records = []
-    tree = etree.parse(manifest_filename)
-    for file_el in tree.findall('file'):
+    for _, file_el in etree.iterparse(manifest_filename, tag='file'):
         file_info = {
             subel.tag: subel.text
             for subel in file_el
@@ -27,6 +37,11 @@ def read_manifest(manifest_filename):
         yymm = file_info.pop('yymm')
         file_info['month'] = ('19' if yymm[0] == '9' else '20') + yymm
         manifest_records.append(file_info)
+
+        # Drop parsed elements, so the whole manifest tree is never kept in memory.
+        file_el.clear()
+        while file_el.getprevious() is not None:
+            del file_el.getparent()[0]
     return manifest_records
 
 
@@ -39,6 +54,282 @@ def filter_archives(manifest_records, start_month, finish_month):
     return filtered_records
 
 
+def read_snapshot(snapshot_path):
+    """
+    Snapshot is a jsonl file of [filename, md5sum, seq_num] for every archive handed to the tar stage.
+    Later lines override earlier ones.
+    """
+    snapshot = {}
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path) as f:
+            for line in f:
+                filename, md5sum, seq_num = json.loads(line)
+                snapshot[filename] = (md5sum, seq_num)
+    return snapshot
+
+
+def write_snapshot(snapshot, snapshot_path):
+    with open(snapshot_path + '.tmp', 'w') as f:
+        for filename, (md5sum, seq_num) in snapshot.items():
+            f.write(json.dumps([filename, md5sum, seq_num]) + '\n')
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+
+
+def append_snapshot(archive, snapshot_path):
+    with open(snapshot_path, 'a') as f:
+        f.write(json.dumps([archive['filename'], archive.get('md5sum'), archive['seq_num']]) + '\n')
+
+
+def diff_manifest(manifest_records, snapshot):
+    """
+    Returns records that are new or changed since the snapshot was taken.
+    """
+    return [record for record in manifest_records
+            if snapshot.get(record['filename']) != (record.get('md5sum'), record['seq_num'])]
+
+
+def make_bucket_getter(access_key, secret_key, headers):
+    local = threading.local()
+
+    def get_bucket():
+        # boto connections are not thread-safe, so every worker keeps its own.
+        if not hasattr(local, 'bucket'):
+            s3 = boto.connect_s3(access_key, secret_key)
+            local.bucket = s3.get_bucket('arxiv', headers=headers)
+        return local.bucket
+    return get_bucket
+
+
+def read_done_ranges(path):
+    """
+    Returns byte spans of `path` that are already downloaded. Spans of an unfinished download are
+    listed in the `<path>.parts` file, a file without it is a plain (maybe partial) sequential download.
+    """
+    parts_path = path + '.parts'
+    if os.path.exists(parts_path):
+        with open(parts_path) as f:
+            return [tuple(int(x) for x in line.split()) for line in f if line.strip()]
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        return [(0, os.path.getsize(path) - 1)]
+    return []
+
+
+def missing_ranges(done, size, part_size):
+    ranges = []
+    pos = 0
+    for start, end in sorted(done) + [(size, size)]:
+        while pos < start:
+            part_end = min(pos + part_size, start) - 1
+            ranges.append((pos, part_end))
+            pos = part_end + 1
+        pos = max(pos, end + 1)
+    return ranges
+
+
+def download_range(get_bucket, key_name, path, start, end, headers, parts_file, lock):
+    range_headers = dict(headers, Range='bytes=%d-%d' % (start, end))
+    key = get_bucket().new_key(key_name)
+    with open(path, 'r+b') as f:
+        f.seek(start)
+        key.get_contents_to_file(f, headers=range_headers)
+    with lock:
+        parts_file.write('%d %d\n' % (start, end))
+        parts_file.flush()
+
+
+def download_archive(get_bucket, archive, path, headers, part_size, part_concurrency):
+    size = archive['size']
+    done = read_done_ranges(path)
+    ranges = missing_ranges(done, size, part_size)
+    if not ranges:
+        return
+    if done:
+        logger.info('%s: resuming, %d bytes left' % (os.path.split(path)[1],
+                                                     sum(end - start + 1 for start, end in ranges)))
+
+    parts_path = path + '.parts'
+    with open(parts_path, 'w') as parts_file:
+        for start, end in done:
+            parts_file.write('%d %d\n' % (start, end))
+        parts_file.flush()
+        with open(path, 'ab') as f:
+            f.truncate(size)
+
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=part_concurrency) as pool:
+            futures = [pool.submit(download_range, get_bucket, archive['filename'], path, start, end,
+                                   headers, parts_file, lock)
+                       for start, end in ranges]
+            for future in futures:
+                future.result()
+    os.remove(parts_path)
+
+
+def verify_archive(path, archive):
+    if os.path.getsize(path) != archive['size']:
+        return False
+    if archive.get('md5sum') is None:
+        return True
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest() == archive['md5sum']
+
+
+def fetch_archive(get_bucket, hasher, archive, task_dir, headers, part_size, part_concurrency, max_tries=10):
+    """
+    Downloads the archive and hands it to the `hasher` pool. Returns a future of the verification result,
+    so the download worker can start the next archive while this one is being hashed.
+    """
+    archive_name = os.path.split(archive['filename'])[1]
+    archive_task_path = os.path.join(task_dir, archive_name)
+    for _ in range(max_tries):
+        try:
+            logger.info('%s: downloading from arXiv bucket' % archive_name)
+            download_archive(get_bucket, archive, archive_task_path, headers, part_size, part_concurrency)
+            return hasher.submit(verify_archive, archive_task_path, archive)
+        except Exception as e:
+            logger.info('%s: %s. Waiting 30s...' % (archive_name, e))
+            time.sleep(30)
+    logger.error('Too many errors for %s' % archive_name)
+
+
+def download_archives(get_bucket, archives, task_dir, tar_dir, headers,
+                      concurrency, part_size, part_concurrency, snapshot_path=None, max_verify_tries=2,
+                      snapshot=None):
+    """
+    Downloads archives on a pool of `concurrency` workers. Finished archives are moved to `tar_dir`
+    in the order of `archives`, so the tar stage always receives them sorted by month.
+    Only archives that match the manifest size and md5 are moved, and each moved archive is recorded
+    in the snapshot.
+
+    An archive that is in `snapshot` has changed since it was handed to the tar stage: its tar in
+    `tar_dir` is replaced and removed from the ledger of tar2pdf, so the new version is extracted.
+    A local tar of an archive missing from `snapshot` is kept and recorded in the snapshot.
+    """
+    snapshot = snapshot or {}
+    ledger_path = os.path.join(tar_dir, ledger_name)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, ThreadPoolExecutor(max_workers=1) as hasher:
+        def submit(archive):
+            return pool.submit(fetch_archive, get_bucket, hasher, archive, task_dir, headers,
+                               part_size, part_concurrency)
+
+        selected = []
+        for archive in archives:
+            archive_name = os.path.split(archive['filename'])[1]
+            archive_tar_path = os.path.join(tar_dir, archive_name)
+
+            if not os.path.exists(archive_tar_path) or archive['filename'] in snapshot:
+                selected.append(archive)
+            else:
+                logger.info('%s: local archive found' % archive_name)
+                if snapshot_path is not None:
+                    append_snapshot(archive, snapshot_path)
+
+        # At most 2 * concurrency archives are in flight, the next one starts when the oldest is moved,
+        # so a stalled archive doesn't let finished ones fill task dir.
+        queued = iter(selected)
+        futures = deque((archive, submit(archive)) for archive in itertools.islice(queued, 2 * concurrency))
+        for _ in tqdm(range(len(selected))):
+            archive, future = futures.popleft()
+            archive_name = os.path.split(archive['filename'])[1]
+            archive_task_path = os.path.join(task_dir, archive_name)
+            for attempt in range(max_verify_tries):
+                verification = future.result()
+                if verification is None:
+                    break
+                if verification.result():
+                    archive_tar_path = os.path.join(tar_dir, archive_name)
+                    if os.path.exists(archive_tar_path):
+                        logger.info('%s: archive changed, replacing the local one' % archive_name)
+                        forget_extracted(ledger_path, archive_name)
+                    shutil.move(archive_task_path, archive_tar_path)
+                    if snapshot_path is not None:
+                        append_snapshot(archive, snapshot_path)
+                    break
+                logger.error('%s: size or md5 mismatch, archive removed' % archive_name)
+                os.remove(archive_task_path)
+                if attempt + 1 < max_verify_tries:
+                    future = submit(archive)
+            for archive in itertools.islice(queued, 1):
+                futures.append((archive, submit(archive)))
+
+
+class Md5Reader:
+    """
+    File-like wrapper that hashes everything read through it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+
+def stream_archive(get_bucket, archive, pdf_dir, headers):
+    """
+    Reads the archive body from S3 as a stream and extracts its files without storing the tar.
+    Files are extracted to a temporary folder next to `pdf_dir` and moved to `pdf_dir` only if the
+    stream matches the manifest md5, which is the return value.
+    """
+    archive_key = get_bucket().get_key(archive['filename'], headers=headers)
+    # Same filesystem as pdf_dir, so moving is a rename, but out of sight of the converter.
+    tmp_dir = tempfile.mkdtemp(prefix='.stream-', dir=os.path.dirname(os.path.abspath(pdf_dir)))
+    try:
+        archive_key.open_read(headers=headers)
+        try:
+            reader = Md5Reader(archive_key)
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                count, size = extract_members(tar, tmp_dir)
+            # Tar reader stops at the end-of-archive marker, the padding is still needed for md5.
+            for _ in iter(lambda: reader.read(1024 * 1024), b''):
+                pass
+        finally:
+            archive_key.close()
+        if archive.get('md5sum') is not None and reader.md5.hexdigest() != archive['md5sum']:
+            return False
+        for fname in os.listdir(tmp_dir):
+            os.replace(os.path.join(tmp_dir, fname), os.path.join(pdf_dir, fname))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info('%s: %d files (%d bytes) extracted to %s' % (os.path.split(archive['filename'])[1],
+                                                             count, size, pdf_dir))
+    return True
+
+
+def fetch_stream(get_bucket, archive, pdf_dir, headers, max_tries=10):
+    archive_name = os.path.split(archive['filename'])[1]
+    for _ in range(max_tries):
+        try:
+            logger.info('%s: streaming from arXiv bucket' % archive_name)
+            return stream_archive(get_bucket, archive, pdf_dir, headers)
+        except Exception as e:
+            logger.info('%s: %s. Waiting 30s...' % (archive_name, e))
+            time.sleep(30)
+    logger.error('Too many errors for %s' % archive_name)
+    return False
+
+
+def stream_archives(get_bucket, archives, pdf_dir, headers, concurrency, snapshot_path=None):
+    """
+    Streaming alternative of `download_archives`: archives never touch the disk, only their
+    files are written to `pdf_dir`.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [(archive, pool.submit(fetch_stream, get_bucket, archive, pdf_dir, headers))
+                   for archive in archives]
+        for archive, future in tqdm(futures):
+            if future.result():
+                if snapshot_path is not None:
+                    append_snapshot(archive, snapshot_path)
+            else:
+                logger.error('%s: md5 mismatch or download failed' % os.path.split(archive['filename'])[1])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log',
@@ -55,6 +346,20 @@ if __name__ == '__main__':
                         help='Date from which the download will begin.')
     parser.add_argument('-f', '--finish-month',
                         help='Date on which the download will end.')
+    parser.add_argument('--concurrency', default=4, type=int,
+                        help='Count of archives downloading at once.')
+    parser.add_argument('--part-size', default=64, type=int,
+                        help='Archives bigger than this size (MB) are downloaded by ranged parts.')
+    parser.add_argument('--part-concurrency', default=4, type=int,
+                        help='Count of parts of one archive downloading at once.')
+    parser.add_argument('--update-manifest', default=False, action='store_true',
+                        help='Download a fresh manifest even if a local one exists.')
+    parser.add_argument('--manifest-max-age', default=24, type=float,
+                        help='Local manifest older than this count of hours is downloaded again.')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='Extract archives while streaming them from S3 instead of storing tars.')
+    parser.add_argument('--pdf-dir', default='pdf',
+                        help='Folder name where tasks will be stored for converting to txt (stream mode).')
     args = parser.parse_args()
 
     setup_logging(logger, args)
@@ -67,54 +372,40 @@ if __name__ == '__main__':
     configs = configparser.ConfigParser()
     configs.read('/run/secrets/keys')
 
-    s3 = boto.connect_s3(configs['DEFAULT']['ACCESS_KEY'], configs['DEFAULT']['SECRET_KEY'])
-
     headers = {'x-amz-request-payer': 'requester'}
-    arxiv_bucket = s3.get_bucket('arxiv', headers=headers)
+    get_bucket = make_bucket_getter(configs['DEFAULT']['ACCESS_KEY'], configs['DEFAULT']['SECRET_KEY'], headers)
+    arxiv_bucket = get_bucket()
     xml_path = os.path.join(args.xml_dir, 'arXiv_pdf_manifest.xml')
 
-    if not os.path.exists(xml_path):
+    snapshot_path = os.path.join(args.xml_dir, 'manifest_snapshot.jsonl')
+
+    if not os.path.exists(xml_path) or args.update_manifest or \
+            time.time() - os.path.getmtime(xml_path) > args.manifest_max_age * 3600:
         if not os.path.exists(args.xml_dir):
             os.mkdir(args.xml_dir)
 
         logger.info('Downloading arxiv_pdf_manifest.xml from arxiv bucket')
         pdf_manifest_key = arxiv_bucket.get_key('pdf/arXiv_pdf_manifest.xml', headers=headers)
-        pdf_manifest_key.get_contents_to_filename(xml_path, headers=headers)
+        pdf_manifest_key.get_contents_to_filename(xml_path + '.tmp', headers=headers)
+        os.replace(xml_path + '.tmp', xml_path)
 
     manifest_records = read_manifest(xml_path)
 
-    selected_archives = filter_archives(manifest_records, args.start_month, args.finish_month)
+    snapshot = read_snapshot(snapshot_path)
+    write_snapshot(snapshot, snapshot_path)
+
+    selected_archives = filter_archives(diff_manifest(manifest_records, snapshot),
+                                        args.start_month, args.finish_month)
     selected_archives.sort(key=lambda record: record['month'])
+    logger.info('%d of %d archives are new or changed' % (len(selected_archives), len(manifest_records)))
 
-    last_path = None
-
-    for archive in tqdm(selected_archives):
-        archive_name = os.path.split(archive['filename'])[1]
-        archive_task_path = os.path.join(args.task_dir, archive_name)
-        archive_tar_path = os.path.join(args.tar_dir, archive_name)
-
-        if not os.path.exists(archive_task_path) and not os.path.exists(archive_tar_path):
-            number_of_attempts = 0
-            stop = False
-            while not stop:
-                if number_of_attempts < 10:
-                    try:
-                        stop = True
-                        if not (last_path is None):
-                            shutil.move(last_path, args.tar_dir)
-                        logger.info('%s: downloading from arXiv bucket' % archive_name)
-                        archive_key = arxiv_bucket.get_key(archive['filename'], headers=headers)
-                        archive_key.get_contents_to_filename(archive_task_path, headers=headers)
-                        last_path = archive_task_path
-                    except:
-                        logger.info("Socket.timeout. Waiting 30s...")
-                        time.sleep(30)
-                        number_of_attempts += 1
-                        stop = False
-                else:
-                    logger.error('Too many errors for %s' % archive_name)
-                    stop = True
-        else:
-            logger.info('%s: local archive found' % archive_name)
+    if args.stream:
+        if not os.path.exists(args.pdf_dir):
+            os.mkdir(args.pdf_dir)
+        stream_archives(get_bucket, selected_archives, args.pdf_dir, headers, args.concurrency, snapshot_path)
+    else:
+        download_archives(get_bucket, selected_archives, args.task_dir, args.tar_dir, headers,
+                          args.concurrency, args.part_size * 1024 * 1024, args.part_concurrency, snapshot_path,
+                          snapshot=snapshot)
 
     logger.info('Tar download completed successfully!')
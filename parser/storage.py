@@ -0,0 +1,90 @@
+import os
+import json
+import shutil
+from mmh3 import hash
+from utils import atomic_open
+
+
+class ShardedStorage:
+    """
+    Corpus layout: <root>/<shard>/<paper>/<artifact>, where shard = mmh3(paper, seed) % shards.
+    Artifacts are 'meta' (<paper>, json), 'pdf' (<paper>.pdf) and layouts stored by extension
+    ('json', 'jsonl', 'npz', 'txt' -> <paper>.<ext>).
+
+    Shards and directories that are known to exist are cached, so writing a paper costs no extra
+    stat/mkdir calls after the first time. Changing `shards` or `seed` of an existing tree makes
+    its papers unreachable.
+    """
+    cache_size = 100000
+
+    def __init__(self, root, seed=42, shards=500):
+        self.root = root
+        self.seed = seed
+        self.shards = shards
+        self.shard_cache = {}
+        self.known_dirs = set()
+
+    def shard(self, paper):
+        shard = self.shard_cache.get(paper)
+        if shard is None:
+            if len(self.shard_cache) >= self.cache_size:
+                self.shard_cache.clear()
+            shard = self.shard_cache[paper] = str(hash(paper, self.seed) % self.shards)
+        return shard
+
+    def paper_dir(self, paper, create=False):
+        shard = self.shard(paper)
+        path = os.path.join(self.root, shard, paper)
+        if create and path not in self.known_dirs:
+            if shard not in self.known_dirs:
+                os.makedirs(os.path.join(self.root, shard), exist_ok=True)
+                self.known_dirs.add(shard)
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                pass
+            if len(self.known_dirs) >= self.cache_size:
+                self.known_dirs = set(d for d in self.known_dirs if os.sep not in d)
+            self.known_dirs.add(path)
+        return path
+
+    def make_shards(self):
+        for i in range(self.shards):
+            os.makedirs(os.path.join(self.root, str(i)), exist_ok=True)
+            self.known_dirs.add(str(i))
+
+    def path(self, paper, kind, create=False):
+        name = paper if kind == 'meta' else paper + '.' + kind
+        return os.path.join(self.paper_dir(paper, create), name)
+
+    def exists(self, paper, kind):
+        return os.path.exists(self.path(paper, kind))
+
+    def open(self, paper, kind, mode='w'):
+        """
+        Atomic writer of an artifact, the file appears under its name only when it's complete.
+        """
+        return atomic_open(self.path(paper, kind, create=True), mode)
+
+    def put_meta(self, paper, meta):
+        """
+        Returns size of the written file.
+        """
+        with self.open(paper, 'meta') as f:
+            json.dump(meta, f, indent=4)
+            return f.tell()
+
+    def get_meta(self, paper):
+        path = self.path(paper, 'meta')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put_file(self, paper, kind, src_path):
+        """
+        Moves an existing file into the storage, a rename within one filesystem is atomic.
+        """
+        dst_path = self.path(paper, kind, create=True)
+        shutil.move(src_path, dst_path)
+        return dst_path
@@ -4,48 +4,183 @@ from watchdog.events import PatternMatchingEventHandler
 import logging
 import argparse
 from utils import setup_logging
+from utils import atomic_open
+from utils import paper_id
+from metastore import open_meta_store
+from catalog import Catalog
 import os
 import tarfile
+import threading
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm.auto import tqdm
 
 
 logger = logging.getLogger(__name__)
+ledger_lock = threading.Lock()
 
 
-def closed(pdf_dir):
+class PaperFilter:
+    """
+    Decides by a tar member name whether the paper should be extracted. Categories and dates are
+    resolved against the meta stored by metaloader, papers without meta are skipped.
+    """
+    def __init__(self, storage, categories=None, date_from=None, date_to=None, ids=None):
+        self.storage = storage
+        self.categories = categories
+        self.date_from = date_from
+        self.date_to = date_to
+        self.ids = ids
+
+    def match_categories(self, categories):
+        for cat in categories.split():
+            for wanted in self.categories:
+                if cat == wanted or cat.startswith(wanted + '.'):
+                    return True
+        return False
+
+    def __call__(self, member_name):
+        arxiv_id = paper_id(member_name)
+        if self.ids is not None and arxiv_id not in self.ids:
+            return False
+        if self.categories is None and self.date_from is None and self.date_to is None:
+            return True
+
+        meta = self.storage.get_meta(arxiv_id)
+        if meta is None:
+            return False
+        if self.date_from is not None and meta['date'] < self.date_from:
+            return False
+        if self.date_to is not None and meta['date'] > self.date_to:
+            return False
+        return self.categories is None or self.match_categories(meta['categories'])
+
+
+def make_filter(args):
+    ids = None
+    if args.id_list is not None:
+        with open(args.id_list) as f:
+            ids = set(paper_id(line.strip()) for line in f if line.strip())
+    if args.categories is None and args.date_from is None and args.date_to is None and ids is None:
+        return None
+    return PaperFilter(open_meta_store(args.meta_store, args.arxiv_dir, args.seed, args.shards),
+                       args.categories, args.date_from, args.date_to, ids)
+
+
+def extract_members(tar, dst_dir, keep=None, catalog=None):
+    """
+    Extracts files of an opened tar in one sequential pass, so it also works for stream tars ('r|*').
+    Members rejected by `keep` are skipped without being written. Extracted pdfs are recorded in
+    `catalog` with their md5 in one transaction at the end.
+    Returns count and total size of the extracted files.
+    """
+    count = size = 0
+    extracted = []
+    for member in tar:
+        if not member.isfile():
+            continue
+        if keep is not None and not keep(member.name):
+            continue
+        fname = member.name.split('/')[-1]
+        src = tar.extractfile(member)
+        md5 = hashlib.md5()
+        with atomic_open(os.path.join(dst_dir, fname), 'wb') as f:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                md5.update(chunk)
+                f.write(chunk)
+        extracted.append((paper_id(fname), fname, member.size, md5.hexdigest()))
+        count += 1
+        size += member.size
+    if catalog is not None:
+        with catalog.transaction():
+            for arxiv_id, fname, pdf_size, pdf_md5 in extracted:
+                catalog.update_pdf(arxiv_id, fname, pdf_size, pdf_md5)
+    return count, size
+
+
+def extract_tar(tar_path, dst_dir, keep=None, catalog_path=None):
+    start = time.time()
+    catalog = Catalog(catalog_path) if catalog_path else None
+    with tarfile.open(tar_path, 'r|*') as tar:
+        count, size = extract_members(tar, dst_dir, keep, catalog)
+    if catalog is not None:
+        catalog.close()
+    return count, size, time.time() - start
+
+
+# Names of tars that were extracted completely, kept in the tar dir, so restarts don't extract them again.
+ledger_name = '.extracted'
+
+
+def read_ledger(ledger_path):
+    """
+    Ledger lines are names of extracted tars, '-' before a name cancels the earlier lines of it.
+    """
+    extracted = set()
+    if os.path.exists(ledger_path):
+        with open(ledger_path) as f:
+            for line in f:
+                name = line.strip()
+                if name.startswith('-'):
+                    extracted.discard(name[1:])
+                elif name:
+                    extracted.add(name)
+    return extracted
+
+
+def mark_extracted(ledger_path, tar_name):
+    with ledger_lock:
+        with open(ledger_path, 'a') as f:
+            f.write(tar_name + '\n')
+
+
+def forget_extracted(ledger_path, tar_name):
+    """
+    Marks a tar as not extracted, so a new version of it under the same name is extracted again.
+    Appending keeps the ledger consistent with a tar2pdf process writing to it at the same time.
+    """
+    mark_extracted(ledger_path, '-' + tar_name)
+
+
+def report(future, tar_path, dst_dir, ledger_path):
+    tar_name = os.path.split(tar_path)[1]
+    try:
+        count, size, elapsed = future.result()
+    except Exception as e:
+        logger.error('%s: extraction failed: %s' % (tar_name, e))
+        return
+    mb = size / 1024 / 1024
+    logger.info('%s extracted to %s: %d files, %.1f MB in %.1fs (%.1f MB/s, %.1f files/s)'
+                % (tar_name, dst_dir, count, mb, elapsed, mb / max(elapsed, 1e-6), count / max(elapsed, 1e-6)))
+    mark_extracted(ledger_path, tar_name)
+
+
+def submit_tar(pool, tar_path, dst_dir, ledger_path, keep=None, catalog_path=None):
+    future = pool.submit(extract_tar, tar_path, dst_dir, keep, catalog_path)
+    future.add_done_callback(lambda f: report(f, tar_path, dst_dir, ledger_path))
+    return future
+
+
+def closed(pool, pdf_dir, ledger_path, keep=None, catalog_path=None):
     pdf_path = pdf_dir
 
     def on_created(event):
-        try:
-            tar = tarfile.open(event.src_path)
-            for member in tar.getmembers():
-                if not member.isdir():
-                    try:
-                        fname = member.name.split('/')[-1]
-                        tar.makefile(member, pdf_path + '/' + fname)
-                    except:
-                        pass
-            logger.info('%s extracted to %s' %(event.src_path.split('/')[-1], pdf_path))
-        except:
-            pass
+        submit_tar(pool, event.src_path, pdf_path, ledger_path, keep, catalog_path)
     return on_created
 
 
-def extract_old(src_dir, dst_dir, list):
-    for tar in tqdm(list, desc='Extracting old files...'):
+def extract_old(pool, src_dir, dst_dir, list, ledger_path, keep=None, catalog_path=None):
+    extracted = read_ledger(ledger_path)
+    futures = []
+    for tar in list:
         filename = os.path.join(src_dir, tar)
-        if not os.path.exists(filename):
-            try:
-                cur_tar = tarfile.open(filename)
-                for member in cur_tar.getmembers():
-                    if not member.isdir():
-                        try:
-                            fname = member.name.split('/')[-1]
-                            cur_tar.makefile(member, dst_dir + '/' + fname)
-                        except:
-                            pass
-            except:
-                pass
+        if tar == ledger_name or tar.endswith('.tmp'):
+            continue
+        if tar not in extracted and os.path.isfile(filename):
+            futures.append(submit_tar(pool, filename, dst_dir, ledger_path, keep, catalog_path))
+    for _ in tqdm(as_completed(futures), total=len(futures), desc='Extracting old files...'):
+        pass
 
 
 if __name__ == '__main__':
@@ -60,10 +195,27 @@ if __name__ == '__main__':
                         help='Folder name where the final result will be stored.')
     parser.add_argument('--done-dir', default='pdf',
                         help='Folder name where tasks will be stored for converting to txt.')
+    parser.add_argument('--workers', default=4, type=int,
+                        help='Count of tars extracting at once.')
+    parser.add_argument('--seed', default=42, type=int,
+                        help='Seed for hash.')
+    parser.add_argument('--shards', default=500, type=int,
+                        help='Count of hash folders in arxiv dir.')
+    parser.add_argument('--meta-store', default='files', choices=['files', 'packed'],
+                        help='Store of meta used by filters: files - json file per paper, packed - segments.')
+    parser.add_argument('--categories', nargs='+', default=None,
+                        help='Extract only papers with one of these categories (main or full, e.g. hep-ph, math.AG).')
+    parser.add_argument('--date-from', default=None,
+                        help='Extract only papers created on this date or later (YYYY-MM-DD).')
+    parser.add_argument('--date-to', default=None,
+                        help='Extract only papers created on this date or earlier (YYYY-MM-DD).')
+    parser.add_argument('--id-list', default=None,
+                        help='File with arxiv ids (one per line) to extract.')
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog filename (default: catalog.sqlite in arxiv dir), keep it on local disk '
+                             'if arxiv dir is on NFS.')
     args = parser.parse_args()
 
-    old_files = os.listdir(args.tar_dir)
-
     if not os.path.exists(args.done_dir):
         os.mkdir(args.done_dir)
     if not os.path.exists(args.tar_dir):
@@ -71,14 +223,23 @@ if __name__ == '__main__':
 
     setup_logging(logger, args)
 
+    ledger_path = os.path.join(args.tar_dir, ledger_name)
+    old_files = os.listdir(args.tar_dir)
+
+    keep = make_filter(args)
+    if not os.path.exists(args.arxiv_dir):
+        os.mkdir(args.arxiv_dir)
+    catalog_path = args.catalog or os.path.join(args.arxiv_dir, 'catalog.sqlite')
+    pool = ProcessPoolExecutor(max_workers=args.workers)
+
     path = args.tar_dir
     patterns = "*"
-    ignore_patterns = ""
+    ignore_patterns = ["*.tmp", "*/" + ledger_name]
     ignore_directories = True
     case_sensitive = True
     event_handler = PatternMatchingEventHandler(patterns, ignore_patterns, ignore_directories, case_sensitive)
 
-    event_handler.on_created = closed(args.done_dir)
+    event_handler.on_created = closed(pool, args.done_dir, ledger_path, keep, catalog_path)
 
     go_recursively = True
     observer = Observer()
@@ -87,10 +248,10 @@ if __name__ == '__main__':
 
     logger.info('Waiting for tars...')
 
-    extract_old(args.tar_dir, args.done_dir, old_files)
+    extract_old(pool, args.tar_dir, args.done_dir, old_files, ledger_path, keep, catalog_path)
     try:
-        while True:
-            pass
+        observer.join()
     except KeyboardInterrupt:
         observer.stop()
-    observer.join()
+        observer.join()
+    pool.shutdown()
@@ -1,8 +1,14 @@
 import re
 import time
+import os
 import logging
+import queue
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 import xml.etree.cElementTree as ET
+from contextlib import contextmanager
 
 
 def setup_logging(logger, args):
@@ -23,100 +29,297 @@ def setup_logging(logger, args):
         logger.addHandler(log_file_handler)
 
 
+@contextmanager
+def atomic_open(path, mode='w', **kwargs):
+    """
+    Writes to `path` + '.tmp' and renames it to `path` on success, so readers (and watchdog
+    handlers, which ignore '*.tmp') never see a half-written file.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+network_fs = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'lustre', 'glusterfs', 'ceph', 'fuse.sshfs')
+
+
+def fs_type(path):
+    """
+    Returns the type of the filesystem `path` is on (from /proc/mounts), None if it's unknown.
+    """
+    path = os.path.realpath(path)
+    best, fs = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best):
+                    best, fs = mount_point, fields[2]
+    except OSError:
+        pass
+    return fs
+
+
+def sqlite_journal_mode(path):
+    """
+    WAL needs shared memory between the processes using a database, which network filesystems don't
+    provide, so databases there fall back to the rollback journal (slower commits, readers wait for
+    writers). Keep the catalog and the cache on local disk to get WAL.
+    """
+    fs = fs_type(os.path.dirname(os.path.abspath(path)))
+    if fs in network_fs:
+        logging.warning("%s is on %s, SQLite WAL is unsafe there, using journal_mode=DELETE." % (path, fs))
+        return 'DELETE'
+    return 'WAL'
+
+
+version_re = re.compile(r"v\d+$")
+
+
+def paper_id(filename):
+    """
+    Converts a file name like 'pdf/0704/0704.0001v2.pdf' or 'hep-ph0001001v1.pdf' to the
+    arxiv id used by metaloader ('0704.0001', 'hep-ph0001001').
+    """
+    name = os.path.split(filename)[1]
+    if name.endswith('.pdf'):
+        name = name[:-4]
+    return version_re.sub('', name)
+
+
 # Download constants
-resume_re = re.compile(r".*<resumptionToken.*?>(.*?)</resumptionToken>.*")
 url = "http://export.arxiv.org/oai2"
+# Minimal seconds between two requests, so as not to get banned.
+request_interval = 20
 
 # Parse constant
-record_tag = ".//{http://www.openarchives.org/OAI/2.0/}record"
+oai_tag = lambda t: "{http://www.openarchives.org/OAI/2.0/}" + t
+record_tag = ".//" + oai_tag("record")
+datestamp_tag = ".//" + oai_tag("datestamp")
 format_tag = lambda t: ".//{http://arxiv.org/OAI/arXiv/}" + t
 date_fmt = "%a, %d %b %Y %H:%M:%S %Z"
 
 
-def download(start_date=None, max_tries=10):
-    params = {"verb": "ListRecords", "metadataPrefix": "arXiv"}
-    if start_date is not None:
-        params["from"] = start_date
+class RateLimiter:
+    """
+    Lets threads sharing it send at most one request per `interval` seconds.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0
 
-    failures = 0
-    while True:
-        # Send the request.
-        r = requests.post(url, data=params)
-        code = r.status_code
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            logging.debug("Sleeping for {0:.1f} seconds so as not to get banned.".format(delay))
+            time.sleep(delay)
+
+
+class OAIError(Exception):
+    """
+    Error of an OAI-PMH response, `code` is like 'badResumptionToken'.
+    """
+    def __init__(self, code):
+        super().__init__("OAI error in response: {0}".format(code))
+        self.code = code
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def host_limiter(base_url, interval=request_interval):
+    """
+    Returns the rate limiter shared by all harvest streams of the host of `base_url`.
+    """
+    host = urlparse(base_url).netloc
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = RateLimiter(interval)
+        return limiters[host]
 
-        # Asked to retry
-        if code == 503:
-            to = int(r.headers["retry-after"])
-            logging.info("Got 503. Retrying after {0:d} seconds.".format(to))
 
-            time.sleep(to)
-            failures += 1
-            if failures >= max_tries:
-                logging.warning("Failed too many times...")
-                break
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-        elif code == 200:
-            failures = 0
 
-            # Write the response to a file.
-            content = r.text
-            yield parse(content)
+def fetch_pages(pages, params, max_tries, base_url, session, limiter):
+    """
+    Fetcher thread of `download`: requests pages on its own schedule and puts (records, token) to
+    `pages`, while the consumer writes previous pages. None marks the end of the harvest.
+    """
+    try:
+        failures = 0
+        while True:
+            # Pause so as not to get banned. Time of parsing and writing is already a part of the pause.
+            limiter.wait()
 
-            # Look for a resumption token.
-            token = resume_re.search(content)
-            if token is None:
-                logging.warning("Cant find resumption token in response: %s", content)
-                break
-            token = token.groups()[0]
+            # Send the request.
+            r = session.post(base_url, data=params, stream=True)
+            code = r.status_code
 
-            # If there isn't one, we're all done.
-            if token == "":
-                logging.info("All done.")
-                break
+            # Asked to retry
+            if code == 503:
+                to = int(r.headers["retry-after"])
+                logging.info("Got 503. Retrying after {0:d} seconds.".format(to))
 
-            logging.debug("Resumption token: {0}.".format(token))
+                time.sleep(to)
+                failures += 1
+                if failures >= max_tries:
+                    raise RuntimeError("Got 503 {0:d} times in a row.".format(failures))
 
-            # If there is a resumption token, rebuild the request.
-            params = {"verb": "ListRecords",
-                      "resumptionToken": token,}
+            elif code == 200:
+                failures = 0
 
-            # Pause so as not to get banned.
-            to = 20
-            logging.debug("Sleeping for {0:d} seconds so as not to get banned."
-                          .format(to))
-            time.sleep(to)
+                # Records and the resumption token are parsed while the body is downloading.
+                r.raw.decode_content = True
+                records, token, error = parse_stream(r.raw)
 
-        else:
-            # Wha happen'?
-            r.raise_for_status()
+                if error == "noRecordsMatch":
+                    logging.info("No new records.")
+                    pages.put(([], ""))
+                    break
+                if error is not None:
+                    raise OAIError(error)
+
+                # A list that fits on one page may have no resumption token, it's the last page too.
+                if token is None:
+                    token = ""
+
+                pages.put((records, token))
+
+                # If there isn't one, we're all done.
+                if token == "":
+                    logging.info("All done.")
+                    break
+
+                logging.debug("Resumption token: {0}.".format(token))
+
+                # If there is a resumption token, rebuild the request.
+                params = {"verb": "ListRecords",
+                          "resumptionToken": token,}
+
+            else:
+                # Wha happen'?
+                r.raise_for_status()
+    except Exception as e:
+        pages.put(e)
+    pages.put(None)
+
+
+def download(start_date=None, max_tries=10, resumption_token=None, base_url=url, interval=request_interval,
+             set_spec=None, session=None, limiter=None):
+    """
+    Yields (records, token) for every page of ListRecords, where token is the resumption token of
+    the next page ('' after the last page). Harvest continues from `resumption_token` if it's set.
+    Pages are fetched by a separate thread, at most two pages ahead of the consumer.
+
+    Failures (including OAI errors, as `OAIError`) are raised after the pages fetched before them.
+
+    `set_spec` restricts the harvest to one OAI set. Streams of several sets can share a pooled
+    `session` and the `limiter` of their host (see `host_limiter`).
+    """
+    params = {"verb": "ListRecords", "metadataPrefix": "arXiv"}
+    if start_date is not None:
+        params["from"] = start_date
+    if set_spec is not None:
+        params["set"] = set_spec
+    if resumption_token is not None:
+        params = {"verb": "ListRecords",
+                  "resumptionToken": resumption_token,}
+
+    if session is None:
+        session = make_session(1)
+    if limiter is None:
+        limiter = RateLimiter(interval)
+
+    pages = queue.Queue(maxsize=2)
+    threading.Thread(target=fetch_pages, args=(pages, params, max_tries, base_url, session, limiter),
+                     daemon=True).start()
+    while True:
+        page = pages.get()
+        if page is None:
+            break
+        if isinstance(page, Exception):
+            raise page
+        yield page
 
 
 class Meta:
+    __slots__ = ('arxiv_id', 'date', 'title', 'abstract', 'categories', 'datestamp')
+
     def __init__(self,
                  arxiv_id,
                  date,
                  title,
                  abstract,
-                 categories):
+                 categories,
+                 datestamp=None):
         self.arxiv_id = arxiv_id
         self.date = date
         self.title = title
         self.abstract = abstract
         self.categories = categories
+        self.datestamp = datestamp
+
+
+def parse_record(r):
+    try:
+        arxiv_id = r.find(format_tag("id")).text
+        date = r.find(format_tag("created")).text
+        title = r.find(format_tag("title")).text
+        abstract = r.find(format_tag("abstract")).text
+        categories = r.find(format_tag("categories")).text
+        datestamp = r.find(datestamp_tag).text
+    except:
+        logging.error("Parsing of record failed:\n{0}".format(r))
+    else:
+        return Meta(''.join(arxiv_id.split('/')), date, title, abstract, categories, datestamp)
 
 
 def parse(xml_data):
     tree = ET.fromstring(xml_data)
     results = []
-    for i, r in enumerate(tree.findall(record_tag)):
-        try:
-            arxiv_id = r.find(format_tag("id")).text
-            date = r.find(format_tag("created")).text
-            title = r.find(format_tag("title")).text
-            abstract = r.find(format_tag("abstract")).text
-            categories = r.find(format_tag("categories")).text
-        except:
-            logging.error("Parsing of record failed:\n{0}".format(r))
-        else:
-            results.append(Meta(''.join(arxiv_id.split('/')), date, title, abstract, categories))
+    for r in tree.findall(record_tag):
+        meta = parse_record(r)
+        if meta is not None:
+            results.append(meta)
     return results
+
+
+def parse_stream(stream):
+    """
+    Parses a ListRecords response from a file-like object in one pass.
+    Returns records, resumption token (None if the response has no token) and OAI error code.
+    """
+    results = []
+    token = error = None
+    for _, el in ET.iterparse(stream):
+        if el.tag == oai_tag("record"):
+            meta = parse_record(el)
+            if meta is not None:
+                results.append(meta)
+            el.clear()
+        elif el.tag == oai_tag("resumptionToken"):
+            token = el.text or ""
+        elif el.tag == oai_tag("error"):
+            error = el.get("code")
+    return results, token, error
@@ -0,0 +1,86 @@
+"""
+Local OAI-PMH server for tests: serves ListRecords of the arXiv metadata format from a dict of
+sets, `page_size` records per page, with resumption tokens.
+"""
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+RECORD = ('<record><header><identifier>oai:arXiv.org:{id}</identifier><datestamp>{datestamp}</datestamp>'
+          '</header><metadata><arXiv xmlns="http://arxiv.org/OAI/arXiv/"><id>{id}</id><created>{date}</created>'
+          '<title>{title}</title><abstract>{abstract}</abstract><categories>{categories}</categories>'
+          '</arXiv></metadata></record>')
+
+
+class OAIStub:
+    """
+    `sets` maps a set name to a list of record dicts (id, datestamp, date, title, abstract,
+    categories); requests without a set get the records of all sets. Pages without a next page
+    have no resumption token when `token_on_last_page` is False, like a short OAI response.
+    """
+    def __init__(self, sets, page_size=2, token_on_last_page=True):
+        self.sets = sets
+        self.page_size = page_size
+        self.token_on_last_page = token_on_last_page
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+                stub.requests.append(params)
+                data = stub.respond(params).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def records(self, set_spec, start_date):
+        if set_spec is not None:
+            records = self.sets[set_spec]
+        else:
+            records = list({r['id']: r for rs in self.sets.values() for r in rs}.values())
+        return [r for r in records if start_date is None or r['datestamp'] >= start_date]
+
+    def respond(self, params):
+        if 'resumptionToken' in params:
+            if params['resumptionToken'].count('|') != 2:
+                return ('<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                        '<error code="badResumptionToken">Bad token</error></OAI-PMH>')
+            set_spec, start_date, page = params['resumptionToken'].split('|')
+            set_spec = set_spec or None
+            start_date = start_date or None
+            page = int(page)
+        else:
+            set_spec, start_date, page = params.get('set'), params.get('from'), 0
+
+        records = self.records(set_spec, start_date)
+        if not records:
+            content = '<error code="noRecordsMatch">No records</error>'
+        else:
+            chunk = records[page * self.page_size:(page + 1) * self.page_size]
+            content = '<ListRecords>%s' % ''.join(
+                RECORD.format(**{k: escape(v) for k, v in r.items()}) for r in chunk)
+            if (page + 1) * self.page_size < len(records):
+                content += '<resumptionToken>%s|%s|%d</resumptionToken>' % (set_spec or '', start_date or '',
+                                                                            page + 1)
+            elif self.token_on_last_page:
+                content += '<resumptionToken></resumptionToken>'
+            content += '</ListRecords>'
+        return '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">%s</OAI-PMH>' % content
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
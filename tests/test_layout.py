@@ -0,0 +1,31 @@
+import numpy as np
+from layout import LayoutBuilder, PageReader, npz_to_json, open_npz
+from storage import ShardedStorage
+
+
+def build_layout(pages):
+    builder = LayoutBuilder()
+    for p in range(pages):
+        for f in range(2):
+            for b in range(p + 1):
+                for l in range(3):
+                    builder.add_line('page %d flow %d block %d line %d ü' % (p, f, b, l), (p, f, b, l))
+                builder.end_block((p, f, b, -1))
+            builder.end_flow()
+        builder.end_page()
+    return builder
+
+
+def test_npz_pages_are_read_from_mapped_arrays(tmp_path):
+    storage = ShardedStorage(str(tmp_path), shards=3)
+    path = storage.path('2101.00001v1', 'npz', create=True)
+    with open(path, 'wb') as f:
+        build_layout(4).save(f)
+
+    arrays = open_npz(path)
+    assert all(isinstance(arrays[name], np.memmap) for name in ('text', 'line_offsets', 'line_bbox'))
+    with np.load(path) as npz:
+        expected = npz_to_json(npz)
+    reader = PageReader(storage)
+    assert list(reader.iter_pages('2101.00001v1')) == expected
+    assert reader.read_page('2101.00001v1', 2) == expected[2]
@@ -0,0 +1,95 @@
+import json
+import pytest
+from oai_stub import OAIStub
+from storage import ShardedStorage
+from catalog import Catalog
+import metaloader
+import utils
+
+
+def record(arxiv_id, datestamp, categories):
+    return {'id': arxiv_id, 'datestamp': datestamp, 'date': '2020-01-01', 'title': 'Title ' + arxiv_id,
+            'abstract': 'Abstract', 'categories': categories}
+
+
+SETS = {
+    'physics': [record('1', '2020-01-01', 'hep-ph'), record('2', '2020-01-02', 'hep-th'),
+                record('3', '2020-01-03', 'hep-ph math.AG')],
+    'math': [record('3', '2020-01-03', 'hep-ph math.AG'), record('4', '2020-01-05', 'math.CO')],
+}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    return ShardedStorage(str(tmp_path / 'arxiv'), shards=5), Catalog(str(tmp_path / 'catalog.sqlite')), \
+        str(tmp_path / 'state.json')
+
+
+def harvested(catalog):
+    return sorted(row[0] for row in catalog.db.execute('SELECT arxiv_id FROM papers'))
+
+
+def test_download_single_page_without_token():
+    with OAIStub(SETS, page_size=10, token_on_last_page=False) as stub:
+        pages = list(utils.download(set_spec='physics', base_url=stub.url, interval=0))
+    assert [len(records) for records, token in pages] == [3]
+    assert pages[-1][1] == ''
+
+
+def test_download_pages_of_set():
+    with OAIStub(SETS, page_size=2) as stub:
+        pages = list(utils.download(start_date='2020-01-02', set_spec='physics', base_url=stub.url, interval=0))
+    assert [[r.arxiv_id for r in records] for records, token in pages] == [['2', '3']]
+    assert stub.requests[0]['set'] == 'physics'
+
+
+def test_sets_are_merged_and_deduplicated(tree, monkeypatch):
+    storage, catalog, state_path = tree
+    written = []
+    put_meta = storage.put_meta
+    monkeypatch.setattr(storage, 'put_meta', lambda paper, meta: written.append(paper) or put_meta(paper, meta))
+    with OAIStub(SETS, page_size=2, token_on_last_page=False) as stub:
+        completed = metaloader.load_meta(storage, catalog, state_path, ['physics', 'math'], interval=0,
+                                         per_stream_limit=True, base_url=stub.url)
+    assert completed
+    assert harvested(catalog) == ['1', '2', '3', '4']
+    assert sorted(written) == ['1', '2', '3', '4']
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state['physics'] == {'from': '2020-01-03', 'token': None, 'last_datestamp': '2020-01-03'}
+    assert state['math'] == {'from': '2020-01-05', 'token': None, 'last_datestamp': '2020-01-05'}
+
+
+def test_incremental_run_starts_from_checkpoint(tree):
+    storage, catalog, state_path = tree
+    with OAIStub(SETS, page_size=2) as stub:
+        metaloader.load_meta(storage, catalog, state_path, ['math'], interval=0, base_url=stub.url)
+        stub.requests.clear()
+        assert metaloader.load_meta(storage, catalog, state_path, ['math'], interval=0, base_url=stub.url)
+    assert stub.requests[0]['from'] == '2020-01-05'
+
+
+def write_token(state_path, token):
+    with open(state_path, 'w') as f:
+        json.dump({'from': '2020-01-01', 'token': token}, f)
+
+
+def read_token(state_path):
+    return metaloader.read_state(state_path)['all']['token']
+
+
+def test_token_is_kept_when_the_server_is_unreachable(tree):
+    storage, catalog, state_path = tree
+    write_token(state_path, 'TOKEN-PAGE-5000')
+    with OAIStub(SETS) as stub:
+        pass
+    assert not metaloader.load_meta(storage, catalog, state_path, interval=0, base_url=stub.url)
+    assert read_token(state_path) == 'TOKEN-PAGE-5000'
+
+
+def test_rejected_token_is_dropped(tree):
+    storage, catalog, state_path = tree
+    write_token(state_path, 'TOKEN-PAGE-5000')
+    with OAIStub(SETS) as stub:
+        assert not metaloader.load_meta(storage, catalog, state_path, interval=0, base_url=stub.url)
+    assert read_token(state_path) is None
@@ -0,0 +1,15 @@
+from metastore import PackedMetaStore
+
+
+def test_reader_survives_compaction(tmp_path):
+    writer = PackedMetaStore(str(tmp_path), shards=1)
+    for version in range(3):
+        for paper in ('1', '2', '3'):
+            writer.put_meta(paper, {'id': paper, 'version': version})
+    reader = PackedMetaStore(str(tmp_path), shards=1)
+    assert reader.get_meta('3')['version'] == 2
+
+    assert writer.compact('0') == 6
+    assert [reader.get_meta(paper) for paper in ('1', '2', '3')] == \
+        [{'id': paper, 'version': 2} for paper in ('1', '2', '3')]
+    assert reader.exists('1') and not reader.exists('1', 'pdf')
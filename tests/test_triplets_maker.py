@@ -0,0 +1,78 @@
+import random
+import numpy as np
+import pytest
+from corpus import Corpus
+import triplets_maker as tm
+
+CATEGORIES = ['hep-ph', 'hep-th', 'hep-lat', 'astro-ph', 'astro-ph.GA', 'cond-mat.str-el', 'gr-qc',
+              'math-ph', 'nlin.CD', 'physics.optics', 'quant-ph', 'math.AG', 'math.AT', 'math.CO',
+              'cs.LG', 'cs.AI', 'q-bio.PE', 'q-fin.ST', 'stat.ML', 'econ.EM']
+
+
+def random_corpus(rng, size):
+    papers = [(str(i), ' '.join(rng.sample(CATEGORIES, rng.randint(1, 6))), None) for i in range(size)]
+    return Corpus.from_papers(papers)
+
+
+def test_category_distances_match_reference():
+    corpus = Corpus.from_papers([(str(i), cat, None) for i, cat in enumerate(CATEGORIES)])
+    cat_dist = tm.category_distances(corpus.category_names)
+    rng = random.Random(0)
+    for _ in range(2000):
+        i, j = rng.randrange(len(CATEGORIES)), rng.randrange(len(CATEGORIES))
+        assert cat_dist[i, j] == tm.distance_between_papers([None, [CATEGORIES[i]]], [None, [CATEGORIES[j]]])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_distances_match_reference(seed):
+    rng = random.Random(seed)
+    corpus = random_corpus(rng, 500)
+    cat_dist = tm.category_distances(corpus.category_names)
+    for target in rng.sample(range(len(corpus)), 50):
+        candidates = np.array([rng.randrange(len(corpus)) for _ in range(100)])
+        dists = tm.batch_distances(corpus, cat_dist, target, candidates)
+        # Exactly equal floats, not approximately.
+        assert dists.tolist() == [tm.distance_between_papers(corpus[target], corpus[c]) for c in candidates]
+
+
+@pytest.mark.parametrize('mode', ['random', 'range'])
+def test_output_does_not_depend_on_workers(tmp_path, mode):
+    corpus = random_corpus(random.Random(1), 600)
+    outputs = []
+    for workers in (1, 3):
+        path = str(tmp_path / ('%s_%d.jsonl' % (mode, workers)))
+        tm.save_triplets(corpus, 2, None, mode, path, workers, 42, 50, bands=(0, 2, 3, 5))
+        with open(path) as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].count('\n') > 0
+
+
+def test_size_limit(tmp_path):
+    corpus = random_corpus(random.Random(2), 300)
+    path = str(tmp_path / 'triplets.jsonl')
+    tm.save_triplets(corpus, 3, 123, 'random', path, 2, 42, 10)
+    with open(path) as f:
+        assert sum(1 for _ in f) == 123
+
+
+def test_auto_dedup_only_for_duplicate_ids():
+    unique = Corpus.from_papers([('1', 'hep-ph', None), ('2', 'hep-th', None)])
+    repeated = Corpus.from_papers([('1', 'hep-ph', None), ('1', 'hep-ph', None)])
+    assert tm.make_dedup('auto', 10, 1e-6, unique) is None
+    assert isinstance(tm.make_dedup('auto', 10, 1e-6, repeated), tm.HashSet)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_range_index_bands_match_batch_distances(seed):
+    corpus = random_corpus(random.Random(seed), 400)
+    cat_dist = tm.category_distances(corpus.category_names)
+    index = tm.RangeIndex(corpus)
+    for target in range(0, len(corpus), 9):
+        dists = tm.batch_distances(corpus, cat_dist, target, np.arange(len(corpus)))
+        for low, high in [(0, 2), (3, 5), (2.5, 3.5)]:
+            entry = index.distances(target)
+            band = index.band(entry, low, high)
+            papers = dict(index.paper(entry, band, k) for k in range(band[0][-1] if len(band[0]) else 0))
+            expected = np.flatnonzero((low <= dists) & (dists <= high))
+            assert papers == {p: float(dists[p]) for p in expected.tolist()}
@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 import json
 import os
+import sys
 import numpy as np
-import pandas as pd
 import logging
 import argparse
+import math
+import mmh3
+import multiprocessing as mp
 from tqdm.auto import tqdm
 from shutil import copy2
-from random import sample
+from collections import OrderedDict, Counter, deque
+import itertools
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser'))
+from utils import atomic_open
+from catalog import Catalog
+from corpus import Corpus
+from corpus import load_corpus
 
 logger = logging.getLogger(__name__)
 physics_categories = ['astro-ph', 'cond-mat', 'gr-qc', 'hep-ex', 'hep-lat', 'hep-ph',
@@ -29,8 +38,7 @@ def setup_logging(logger):
     logger.addHandler(console_handler)
 
 
-def get_meta(arx_path):
-    meta = []
+def scan_meta(arx_path):
     errors = 0
     logger.info('Meta is loading...')
     samples = os.listdir(arx_path)
@@ -38,10 +46,27 @@ def get_meta(arx_path):
         if len([name for name in os.listdir(os.path.join(arx_path, sample))]) == 3:
             with open(os.path.join(arx_path, sample, sample)) as f:
                 tmp = json.load(f)
-                meta.append([tmp['id'], tmp['categories'].split()])
+                yield tmp['id'], tmp['categories'], tmp.get('date')
         else:
             errors += 1
-    logger.info('Meta is ready! Current size is {}. Failed: {}'.format(len(meta), errors))
+    logger.info('Failed: {}'.format(errors))
+
+
+def get_meta(arx_path, catalog_path=None, corpus_path=None):
+    """
+    Returns the papers as a `Corpus`. With a catalog its snapshot in `corpus_path` is reused until
+    the catalog changes. Without catalog the arxiv dir is scanned every time: files added inside
+    paper folders don't change any mtime that could invalidate a snapshot.
+    """
+    if catalog_path is not None and os.path.exists(catalog_path):
+        read_papers = lambda: Catalog(catalog_path).complete_papers(with_date=True)
+        if corpus_path is None:
+            meta = Corpus.from_papers(read_papers())
+        else:
+            meta = load_corpus(corpus_path, [catalog_path, catalog_path + '-wal'], read_papers)
+    else:
+        meta = Corpus.from_papers(scan_meta(arx_path))
+    logger.info('Meta is ready! Current size is {}.'.format(len(meta)))
     return meta
 
 
@@ -74,80 +99,440 @@ def distance_between_papers(p1, p2):
     return res_distance / len(p1[1])
 
 
-def triplet_rand(meta, samp):
+def category_distances(categories):
+    """
+    Matrix of distances between categories, by the definition of `distance_between_papers`.
+    """
+    dist = np.zeros((len(categories), len(categories)), dtype=np.int8)
+    for i, c1 in enumerate(categories):
+        for j, c2 in enumerate(categories):
+            dist[i, j] = distance_between_papers([None, [c1]], [None, [c2]])
+    return dist
+
+
+def batch_distances(meta, cat_dist, target, candidates):
+    """
+    Distances from paper `target` to papers `candidates` (indexes in meta), equal to
+    `distance_between_papers`: integer sums per target category are divided by the count of
+    candidate categories and summed in the same order before dividing by the count of target categories.
+    """
+    target_cats = meta.paper_cats(target)
+    cat_offsets, cat_ids = meta.gather_cats(candidates)
+    sums = np.add.reduceat(cat_dist[target_cats][:, cat_ids].astype(np.int64), cat_offsets[:-1], axis=1)
+    means = sums / np.diff(cat_offsets)
+    return np.cumsum(means, axis=0)[-1] / len(target_cats)
+
+
+def triplet_rand(meta, cat_dist, t, rng):
     count = 0
     while True:
-        p, n = np.random.randint(0, len(meta), 2)
-        dist_p = distance_between_papers(samp, meta[p])
-        dist_n = distance_between_papers(samp, meta[n])
-        if samp[0] != meta[p][0] and samp[0] != meta[n][0] and meta[p][0] != meta[n][0] and dist_p != dist_n:
+        p, n = rng.integers(0, len(meta), 2)
+        dist_p, dist_n = batch_distances(meta, cat_dist, t, np.array([p, n])).tolist()
+        target, pos, neg = meta.ids[t], meta.ids[p], meta.ids[n]
+        if target != pos and target != neg and pos != neg and dist_p != dist_n:
             if dist_p > dist_n:
-                return {'target': samp[0], 'context': meta[n][0], 'negative': meta[p][0],
+                return {'target': target.decode(), 'context': neg.decode(), 'negative': pos.decode(),
                         'dist_to_context': round(dist_n, 1), 'dist_to_negative': round(dist_p, 1)}
             else:
-                return {'target': samp[0], 'context': meta[p][0], 'negative': meta[n][0],
+                return {'target': target.decode(), 'context': pos.decode(), 'negative': neg.decode(),
                         'dist_to_context': round(dist_p, 1), 'dist_to_negative': round(dist_n, 1)}
         count += 1
         if count > 15:
             break
 
 
+class RangeIndex:
+    """
+    Papers grouped by signature - the sorted categories of a paper; distance to a paper depends only
+    on its signature. Distance between two categories depends only on whether they are equal, share
+    the main category or are both physics ones and on their counts of parts, so the sums of
+    `batch_distances` come from a few counts per signature instead of its categories:
+
+        sum(d(c1, c2) for c2 in sig) = size * parts(c1) + parts(sig) - 2 * same_main(c1)
+                                       + (nonphysics(sig) if physics(c1) else size - same_main(c1))
+                                       - (2 * parts(c1) - 2 if c1 in sig else 0)
+
+    Only signatures found through the main category index of the target ('near' ones) have
+    same_main > 0. The others ('far' ones) are grouped by profile - counts of their categories by
+    (physics, parts) - and a profile costs one distance. Distances are cached per target categories
+    and both bands of a triplet are cut from them.
+
+    A paper within a band is drawn uniformly: an entry (a near signature or the far papers of a
+    profile) is picked in proportion to its count of papers, then a paper of that entry.
+    """
+    cache_size = 256
+    near_cache_size = 32
+
+    def __init__(self, meta):
+        self.meta = meta
+        names = meta.category_names
+        main_ids = {}
+        self.cat_main = np.array([main_ids.setdefault(c.split('.')[0], len(main_ids)) for c in names], dtype=np.int64)
+        self.cat_parts = np.array([len(c.split('.')) for c in names], dtype=np.int64)
+        self.cat_physics = np.array([c.split('.')[0] in physics_categories for c in names], dtype=bool)
+        class_ids = {}
+        cat_class = [class_ids.setdefault((bool(self.cat_physics[c]), int(self.cat_parts[c])), len(class_ids))
+                     for c in range(len(names))]
+        self.class_physics = np.array([physics for physics, parts in class_ids], dtype=bool)
+        self.class_parts = np.array([parts for physics, parts in class_ids], dtype=np.int64)
+
+        sig_ids = {}
+        paper_sig = np.empty(len(meta), dtype=np.int64)
+        for i in range(len(meta)):
+            key = tuple(sorted(meta.paper_cats(i).tolist()))
+            paper_sig[i] = sig_ids.setdefault(key, len(sig_ids))
+        profile_ids = {}
+        sig_profile = np.empty(len(sig_ids), dtype=np.int64)
+        for s, key in enumerate(sig_ids):
+            counts = [0] * len(class_ids)
+            for c in key:
+                counts[cat_class[c]] += 1
+            sig_profile[s] = profile_ids.setdefault(tuple(counts), len(profile_ids))
+
+        # Signatures are numbered by profile, so papers of a profile are one range of sig_papers.
+        order = np.argsort(sig_profile, kind='stable')
+        renumber = np.empty(len(order), dtype=np.int64)
+        renumber[order] = np.arange(len(order))
+        self.paper_sig = renumber[paper_sig]
+        self.sig_counts = np.bincount(self.paper_sig, minlength=len(sig_ids))
+        self.sig_offsets = np.zeros(len(sig_ids) + 1, dtype=np.int64)
+        np.cumsum(self.sig_counts, out=self.sig_offsets[1:])
+        self.sig_papers = np.argsort(self.paper_sig, kind='stable')
+
+        keys = list(sig_ids)
+        self.sig_size = np.array([len(keys[s]) for s in order.tolist()], dtype=np.int64)
+        self.sig_parts = np.array([int(self.cat_parts[list(keys[s])].sum()) for s in order.tolist()], dtype=np.int64)
+        self.sig_nonphysics = np.array([int((~self.cat_physics[list(keys[s])]).sum()) for s in order.tolist()],
+                                       dtype=np.int64)
+        main_sigs = [[] for _ in main_ids]
+        main_counts = [[] for _ in main_ids]
+        cat_sigs = [[] for _ in names]
+        for new_id, s in enumerate(order.tolist()):
+            for m, count in Counter(self.cat_main[list(keys[s])].tolist()).items():
+                main_sigs[m].append(new_id)
+                main_counts[m].append(count)
+            for c in keys[s]:
+                cat_sigs[c].append(new_id)
+        self.main_sigs = [np.array(sigs, dtype=np.int64) for sigs in main_sigs]
+        self.main_counts = [np.array(counts, dtype=np.int64) for counts in main_counts]
+        self.cat_sigs = [np.array(sigs, dtype=np.int64) for sigs in cat_sigs]
+
+        self.profile_counts = np.array(list(profile_ids), dtype=np.int64).reshape(len(profile_ids), len(class_ids))
+        self.profile_sizes = self.profile_counts.sum(axis=1)
+        profile_sigs = np.zeros(len(profile_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sig_profile, minlength=len(profile_ids)), out=profile_sigs[1:])
+        self.profile_offsets = self.sig_offsets[profile_sigs]
+        self.near_cache = OrderedDict()
+        self.cache = OrderedDict()
+
+    def near_set(self, mains):
+        """
+        Returns the signatures sharing a main category in `mains` with their counts, and the numbering
+        of the other (far) papers, which skips papers of these signatures in the order of sig_papers.
+        """
+        key = tuple(sorted(mains))
+        near_set = self.near_cache.get(key)
+        if near_set is not None:
+            self.near_cache.move_to_end(key)
+            return near_set
+        is_near = np.zeros(len(self.sig_counts), dtype=bool)
+        for m in key:
+            is_near[self.main_sigs[m]] = True
+        near = np.flatnonzero(is_near)
+        rank = np.cumsum(is_near, dtype=np.int32) - 1
+        same = {}
+        for m in key:
+            same[m] = np.zeros(len(near), dtype=np.int64)
+            same[m][rank[self.main_sigs[m]]] = self.main_counts[m]
+        starts = self.sig_offsets[near]
+        skipped = np.zeros(len(near) + 1, dtype=np.int64)
+        np.cumsum(self.sig_counts[near], out=skipped[1:])
+        far_offsets = self.profile_offsets - skipped[np.searchsorted(starts, self.profile_offsets)]
+        near_set = self.near_cache[key] = {
+            'near': near,
+            'rank': rank,
+            'size': self.sig_size[near],
+            'parts': self.sig_parts[near],
+            'nonphysics': self.sig_nonphysics[near],
+            'same': same,
+            'far_offsets': far_offsets,
+            'far_counts': np.diff(far_offsets),
+            'far_skips': starts - skipped[:-1],
+            'skipped': skipped,
+        }
+        if len(self.near_cache) > self.near_cache_size:
+            self.near_cache.popitem(last=False)
+        return near_set
+
+    def near_distances(self, cats, near_set):
+        """
+        Distances from a paper with categories `cats` to its near signatures, in the same operations
+        as `batch_distances` after the integer sums.
+        """
+        size = near_set['size']
+        total = None
+        for c in cats.tolist():
+            same = near_set['same'][self.cat_main[c]]
+            parts = self.cat_parts[c]
+            sums = size * parts + near_set['parts'] - 2 * same + \
+                (near_set['nonphysics'] if self.cat_physics[c] else size - same)
+            sums[near_set['rank'][self.cat_sigs[c]]] -= 2 * parts - 2
+            # Left to right, like the cumsum of batch_distances.
+            total = sums / size if total is None else total + sums / size
+        return total / len(cats)
+
+    def profile_distances(self, cats):
+        """
+        Distances from a paper with categories `cats` to papers of every profile that share no main
+        category with it.
+        """
+        dist = self.cat_parts[cats][:, None] + self.class_parts[None, :] + \
+            ~(self.cat_physics[cats][:, None] & self.class_physics[None, :])
+        return np.cumsum(dist @ self.profile_counts.T / self.profile_sizes, axis=0)[-1] / len(cats)
+
+    def distances(self, t):
+        """
+        Returns distances from paper `t` to its near signatures and to the far papers of every profile.
+        """
+        # Order of the target categories matters for rounding of the distance.
+        key = tuple(self.meta.paper_cats(t).tolist())
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            return entry
+        cats = self.meta.paper_cats(t)
+        near_set = self.near_set(set(self.cat_main[cats].tolist()))
+        entry = self.cache[key] = {
+            'near_set': near_set,
+            'near_dists': self.near_distances(cats, near_set),
+            'far_dists': self.profile_distances(cats),
+            'bands': {},
+        }
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return entry
+
+    def band(self, entry, low, high):
+        """
+        Returns cumulative counts of papers, first positions and distances of the entries with
+        distance in [low, high], and count of near signatures among them (they go first).
+        """
+        band = entry['bands'].get((low, high))
+        if band is None:
+            near_set = entry['near_set']
+            near_dists, far_dists = entry['near_dists'], entry['far_dists']
+            near = np.flatnonzero((low <= near_dists) & (near_dists <= high))
+            far = np.flatnonzero((low <= far_dists) & (far_dists <= high) & (near_set['far_counts'] > 0))
+            sigs = near_set['near'][near]
+            band = entry['bands'][(low, high)] = (
+                np.cumsum(np.concatenate([self.sig_counts[sigs], near_set['far_counts'][far]])),
+                np.concatenate([self.sig_offsets[sigs], near_set['far_offsets'][far]]),
+                np.concatenate([near_dists[near], far_dists[far]]),
+                len(near))
+        return band
+
+    def paper(self, entry, band, k):
+        """
+        Returns the paper number `k` of a band and its distance.
+        """
+        cum_counts, firsts, dists, near_count = band
+        s = np.searchsorted(cum_counts, k, side='right')
+        position = firsts[s] + k - (cum_counts[s - 1] if s else 0)
+        if s >= near_count:
+            near_set = entry['near_set']
+            position += near_set['skipped'][np.searchsorted(near_set['far_skips'], position, side='right')]
+        return self.sig_papers[position], float(dists[s])
+
+    def sample(self, t, low, high, rng):
+        """
+        Returns a random paper other than `t` with distance in [low, high] and its distance, or None.
+        """
+        entry = self.distances(t)
+        band = self.band(entry, low, high)
+        count = band[0][-1] if len(band[0]) else 0
+        if not count:
+            return None
+        while True:
+            paper, dist = self.paper(entry, band, rng.integers(count))
+            if paper != t:
+                return paper, dist
+            if count == 1:
+                return None
+
+
 def triplet_range(low_s, low_f, high_s, high_f):
     low_s = low_s
     low_f = low_f
     high_s = high_s
     high_f = high_f
-
-    def closed(meta, samp):
-        count = 0
-        pos = neg = None
-        dist_p = dist_n = 0
-        repeat_list = []
-        while True:
-            indexes = np.random.randint(0, len(meta), 1000)
-            for i in indexes:
-                if meta[i][0] != samp[0]:
-                    dist = distance_between_papers(samp, meta[i])
-                    if low_s <= dist <= low_f and pos is None:
-                        pos = meta[i]
-                        dist_p = dist
-                    elif high_s <= dist <= high_f and neg is None:
-                        neg = meta[i]
-                        dist_n = dist
-                    if pos is not None and neg is not None:
-                        if [pos[0], neg[0]] not in repeat_list:
-                            repeat_list.append([pos[0], neg[0]])
-                            return {'target': samp[0], 'context': pos[0], 'negative': neg[0],
-                                    'dist_to_context': round(dist_p, 1), 'dist_to_negative': round(dist_n, 1)}
-            count += 1
-            if count > 15:
-                break
+    index = None
+
+    def closed(meta, cat_dist, t, rng):
+        nonlocal index
+        if index is None or index.meta is not meta:
+            index = RangeIndex(meta)
+        pos = index.sample(t, low_s, low_f, rng)
+        neg = index.sample(t, high_s, high_f, rng)
+        if pos is not None and neg is not None:
+            return {'target': meta.ids[t].decode(), 'context': meta.ids[pos[0]].decode(),
+                    'negative': meta.ids[neg[0]].decode(),
+                    'dist_to_context': round(pos[1], 1), 'dist_to_negative': round(neg[1], 1)}
 
     return closed
 
 
-def get_triplets(meta, repeat, size, mode):
-    bar = tqdm(total=size if size is not None else len(meta) * repeat)
-    triplets = []
+class HashSet:
+    """
+    Exact set of triplets kept as 64-bit hashes of their keys.
+    """
+    def __init__(self):
+        self.hashes = set()
+
+    def add(self, key):
+        """
+        Adds a key, returns False if it was already added.
+        """
+        h = mmh3.hash64(key, signed=False)[0]
+        if h in self.hashes:
+            return False
+        self.hashes.add(h)
+        return True
+
+    def error_rate(self):
+        # Collisions of 64-bit hashes.
+        return len(self.hashes) / 2 ** 64
 
+
+class BloomFilter:
+    """
+    Set of triplets in a fixed bit array, sized for `capacity` keys with false positive rate `error`.
+    Bit positions come from the two halves of mmh3.hash64 (double hashing).
+    """
+    def __init__(self, capacity, error):
+        self.bits_count = max(8, int(math.ceil(-capacity * math.log(error) / math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.bits_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bits_count + 7) // 8)
+        self.count = 0
+
+    def add(self, key):
+        """
+        Adds a key, returns False if it was (probably) already added.
+        """
+        h1, h2 = mmh3.hash64(key, signed=False)
+        positions = [(h1 + i * h2) % self.bits_count for i in range(self.hash_count)]
+        if all(self.bits[p >> 3] & (1 << (p & 7)) for p in positions):
+            return False
+        for p in positions:
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        return True
+
+    def error_rate(self):
+        """
+        Expected false positive rate for the keys added so far.
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.bits_count)) ** self.hash_count
+
+
+worker_state = {}
+
+
+def init_worker(meta, cat_dist, mode, bands, repeat, seed, slice_size):
+    """
+    Only picklable arguments are passed, so workers work with any start method; the maker is built here.
+    """
     maker = triplet_rand
     if mode == 'range':
-        maker = range_trip
-
-    for samp in meta:
-        for i in range(repeat):
-            triplet = maker(meta, samp)
-            if triplet is not None:
-                triplets.append(triplet)
-                bar.update(1)
-            if len(triplets) == size:
-                return triplets
-    bar.close()
+        maker = triplet_range(*bands)
+    worker_state.update(meta=meta, cat_dist=cat_dist, maker=maker, repeat=repeat, seed=seed,
+                        slice_size=slice_size)
 
-    return triplets
+
+def make_slice(slice_idx):
+    """
+    Returns (key, json line) of the triplets of targets in one slice of meta. The random generator
+    of a slice is seeded by (seed, slice_idx), so output doesn't depend on count of workers.
+    A (context, negative) pair is used once per target, a repeated pair is drawn again.
+    """
+    meta = worker_state['meta']
+    cat_dist = worker_state['cat_dist']
+    maker = worker_state['maker']
+    slice_size = worker_state['slice_size']
+    rng = np.random.default_rng([worker_state['seed'], slice_idx])
+    lines = []
+    for t in range(slice_idx * slice_size, min(len(meta), (slice_idx + 1) * slice_size)):
+        pairs = set()
+        for i in range(worker_state['repeat']):
+            for tries in range(16):
+                triplet = maker(meta, cat_dist, t, rng)
+                if triplet is None or (triplet['context'], triplet['negative']) not in pairs:
+                    break
+            if triplet is not None and (triplet['context'], triplet['negative']) not in pairs:
+                pairs.add((triplet['context'], triplet['negative']))
+                key = '%s\t%s\t%s' % (triplet['target'], triplet['context'], triplet['negative'])
+                lines.append((key, json.dumps(triplet)))
+    return lines
+
+
+def save_triplets(meta, repeat, size, mode, triplets_path, workers, seed, slice_size, dedup=None, bands=None):
+    """
+    Generates triplets of slices of meta on a process pool and writes them in the order of slices
+    as they are ready. At most 2 * workers slices are submitted and not yet written, so memory
+    doesn't grow when workers are faster than the writer. Triplets rejected by `dedup` (HashSet or
+    BloomFilter) are not written. `bands` are (low_s, low_f, high_s, high_f) of the range mode.
+    """
+    bar = tqdm(total=size if size is not None else len(meta) * repeat)
+
+    cat_dist = category_distances(meta.category_names)
+    slices = iter(range((len(meta) + slice_size - 1) // slice_size))
+    count = dropped = 0
+    with atomic_open(triplets_path) as f, \
+            mp.Pool(workers, initializer=init_worker,
+                    initargs=(meta, cat_dist, mode, bands, repeat, seed, slice_size)) as pool:
+        pending = deque(pool.apply_async(make_slice, (i,)) for i in itertools.islice(slices, 2 * workers))
+        while pending:
+            lines = pending.popleft().get()
+            for i in itertools.islice(slices, 1):
+                pending.append(pool.apply_async(make_slice, (i,)))
+            written = 0
+            for key, line in lines:
+                if dedup is not None and not dedup.add(key):
+                    dropped += 1
+                    continue
+                f.write(line)
+                f.write('\n')
+                written += 1
+                if count + written == size:
+                    break
+            count += written
+            bar.update(written)
+            if count == size:
+                break
+    bar.close()
+    logger.info('Triplets successfully saved!(Count: {})({})'.format(count, triplets_path))
+    if dedup is not None:
+        logger.info('Duplicates dropped: {}. Expected false positive rate: {:.2e}.'.format(dropped,
+                                                                                         dedup.error_rate()))
 
 
-def make_triplets(repeat, low_s=None, low_f=None, high_s=None, high_f=None):
+def make_dedup(kind, capacity, error, meta=None):
+    """
+    Run-wide filter of triplets. Pairs are already unique per target, so triplets can repeat only if
+    meta has duplicate ids: 'auto' uses the exact set then and no filter otherwise. A Bloom filter
+    also drops about `error` of the valid triplets (its false positives).
+    """
+    if kind == 'auto':
+        kind = 'set' if meta is not None and len(np.unique(meta.ids)) < len(meta) else 'none'
+        logger.info('Run-wide dedup: {}.'.format(kind))
+    if kind == 'set':
+        return HashSet()
+    if kind == 'bloom':
+        return BloomFilter(capacity, error)
+    return None
+
+
+def make_triplets(repeat, low_s=None, low_f=None, high_s=None, high_f=None, workers=1, seed=42, slice_size=10000,
+                  dedup='auto', bloom_capacity=None, bloom_error=1e-6):
     low_s = low_s
     low_f = low_f
     high_s = high_s
@@ -155,10 +540,12 @@ def make_triplets(repeat, low_s=None, low_f=None, high_s=None, high_f=None):
     repeat = repeat
 
     def closed(meta, triplet_path, size, mode):
+        capacity = bloom_capacity or max(1, size if size is not None else len(meta) * repeat)
         if mode == 'random':
             if not os.path.exists(os.path.join(triplet_path,
                                                'triplets.jsonl')):
-                save_as_json(get_triplets(meta, repeat, size, mode), os.path.join(triplet_path, 'triplets.jsonl'))
+                save_triplets(meta, repeat, size, mode, os.path.join(triplet_path, 'triplets.jsonl'),
+                              workers, seed, slice_size, make_dedup(dedup, capacity, bloom_error, meta))
             else:
                 logger.info('File is already exist!')
 
@@ -169,27 +556,27 @@ def make_triplets(repeat, low_s=None, low_f=None, high_s=None, high_f=None):
             if not os.path.exists(os.path.join(triplet_path,
                                                'triplets_range({}-{}_{}-{}).jsonl'.format(low_s, low_f, high_s,
                                                                                           high_f))):
-                save_as_json(get_triplets(meta, repeat, size, mode),
-                             os.path.join(triplet_path,
-                                          'triplets_range({}-{}_{}-{}).jsonl'.format(low_s, low_f, high_s, high_f)))
+                save_triplets(meta, repeat, size, mode,
+                              os.path.join(triplet_path,
+                                           'triplets_range({}-{}_{}-{}).jsonl'.format(low_s, low_f, high_s, high_f)),
+                              workers, seed, slice_size, make_dedup(dedup, capacity, bloom_error, meta),
+                              (low_s, low_f, high_s, high_f))
             else:
                 logger.info('File is already exist!')
 
     return closed
 
 
-def save_as_json(triplets, triplets_path):
-    with open(triplets_path, 'w') as f:
-        for triplet in triplets:
-            json.dump(triplet, f)
-            f.write('\n')
-    logger.info('Triplets successfully saved!(Count: {})({})'.format(len(triplets), triplets_path))
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--arxiv-dir', default='arxiv',
                         help='Folder name where stored papers(meta, txt, pdf).')
+    parser.add_argument('--catalog', default=None,
+                        help='Catalog filename (default: catalog.sqlite in arxiv dir), keep it on local disk if arxiv dir is on NFS. '
+                             'Without catalog the arxiv dir is scanned.')
+    parser.add_argument('--corpus-cache', default=None,
+                        help='Corpus snapshot filename (default: corpus.npz in triplets dir). '
+                             'Used only with a catalog.')
     parser.add_argument('--triplets-dir', default='triplets',
                         help='Folder name where triplets are stored in .json format.')
     parser.add_argument('--repeat', default=5, type=int,
@@ -208,6 +595,18 @@ if __name__ == '__main__':
                         help='Seed for random.')
     parser.add_argument('--shuffle', default=True, action='store_true',
                         help='Shuffle your meta.')
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int,
+                        help='Count of processes generating triplets.')
+    parser.add_argument('--slice-size', default=10000, type=int,
+                        help='Count of targets in one task of a worker, output depends on it but not on workers.')
+    parser.add_argument('--dedup', default='auto', choices=['auto', 'none', 'set', 'bloom'],
+                        help='Run-wide dedup of triplets: auto - set only if meta has duplicate ids, '
+                             'set - exact set of hashes, bloom - bounded memory, drops about --bloom-error '
+                             'of valid triplets as false positives.')
+    parser.add_argument('--bloom-capacity', default=None, type=int,
+                        help='Expected count of triplets for the Bloom filter (default: size or meta size * repeat).')
+    parser.add_argument('--bloom-error', default=1e-6, type=float,
+                        help='False positive rate of the Bloom filter at its capacity.')
     parser.add_argument('--size', default=None, type=int,
                         help='Count of triplets.(May be less if meta size is smaller'
                              ' or if for some sample no pair was found on the range.)')
@@ -215,8 +614,6 @@ if __name__ == '__main__':
 
     setup_logging(logger)
 
-    np.random.seed(args.seed)
-
     if not os.path.exists(args.arxiv_dir):
         os.mkdir(args.arxiv_dir)
     if not os.path.exists(args.triplets_dir):
@@ -228,12 +625,13 @@ if __name__ == '__main__':
 
     modes = args.modes
 
-    meta = get_meta(args.arxiv_dir)
+    meta = get_meta(args.arxiv_dir, args.catalog or os.path.join(args.arxiv_dir, 'catalog.sqlite'),
+                    args.corpus_cache or os.path.join(args.triplets_dir, 'corpus.npz'))
     if args.shuffle:
-        meta = sample(meta, len(meta))
+        meta = meta.shuffle(np.random.default_rng(args.seed))
 
-    range_trip = triplet_range(args.pos_dist_s, args.pos_dist_f, args.neg_dist_s, args.neg_dist_f)
-    start = make_triplets(args.repeat, args.pos_dist_s, args.pos_dist_f, args.neg_dist_s, args.neg_dist_f)
+    start = make_triplets(args.repeat, args.pos_dist_s, args.pos_dist_f, args.neg_dist_s, args.neg_dist_f,
+                          args.workers, args.seed, args.slice_size, args.dedup, args.bloom_capacity, args.bloom_error)
 
     for mode in modes:
         start(meta, args.triplets_dir, args.size, mode)